@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import aioserial
+from bms import BmsSample
+from capture import CaptureLog
+from jbd import JbdBms
+from poller import PollPolicy, PollScheduler, SharedBuses, Slot
+from util import get_logger
+
+
+def pump(source, loop: asyncio.AbstractEventLoop, handler):
+    # Blocking queue reads on a helper thread, handled on the loop; None ends it
+    while True:
+        item = source.get()
+        try:
+            loop.call_soon_threadsafe(handler, item)
+        except RuntimeError:
+            # The loop already closed during shutdown
+            return
+        if item is None:
+            return
+
+
+class AcquisitionWorker:
+    """Polls the slots of its own buses on its own event loop and ships the results to the station.
+
+    Runs in a worker thread or process. ``commands`` carries slot occupancy
+    changes and method calls on a bus (probe, set_switch, write_coils...);
+    ``results`` carries sample batches and call replies back. With a
+    ``capture_config`` the worker captures its ports to files of its own.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, name: str, bus_configs: Dict[str, Dict], slots: Dict[int, Tuple[str, float]],
+                 results, commands, serial_factory=aioserial.AioSerial, poll_timeout: float = 3,
+                 idle_interval: float = 10, policy: Optional[PollPolicy] = None,
+                 capture_config: Optional[Dict] = None):
+        self.name = name
+        self.results = results
+        self.commands = commands
+        self.capture = None
+        if capture_config:
+            prefix = f"{capture_config.get('prefix', 'capture')}-{name}"
+            self.capture = CaptureLog(**{**capture_config, 'prefix': prefix})
+            serial_factory = self.capture.wrap(serial_factory)
+        self.buses = {port: JbdBms(**config, serial_factory=serial_factory) for port, config in bus_configs.items()}
+        self.scheduler = PollScheduler({slot_id: Slot(slot_id, self.buses[port], poll_interval)
+                                        for slot_id, (port, poll_interval) in slots.items()},
+                                       poll_timeout=poll_timeout, idle_interval=idle_interval, policy=policy)
+        self.running = True
+        self.wake: Optional[asyncio.Event] = None
+
+    async def run(self):
+        self.wake = asyncio.Event()
+        threading.Thread(target=pump, args=(self.commands, asyncio.get_running_loop(), self.handle),
+                         daemon=True).start()
+        for bus in self.buses.values():
+            await bus.connect()
+        while self.running:
+            results = await self.scheduler.poll_due()
+            if results:
+                self.results.put(('samples', results, self.scheduler.rates(), self.scheduler.utilisation()))
+            # A worker without occupied slots sleeps until a command arrives
+            timeout = self.scheduler.time_until_next() if self.scheduler.occupied_slots() else None
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+        for bus in self.buses.values():
+            bus.disconnect()
+        if self.capture:
+            self.capture.close()
+
+    def handle(self, command):
+        if command is None:
+            self.running = False
+        elif command[0] == 'occupied':
+            _, slot_id, occupied = command
+            if occupied:
+                self.scheduler.mark_occupied(slot_id)
+            else:
+                self.scheduler.mark_empty(slot_id)
+        elif command[0] == 'call':
+            asyncio.create_task(self._call(*command[1:]))
+        self.wake.set()
+
+    async def _call(self, request_id: int, port: str, method: str, args: tuple):
+        try:
+            result = await getattr(self.buses[port], method)(*args)
+            self.results.put(('reply', request_id, result, None))
+        except Exception as e:
+            self.results.put(('reply', request_id, None, f"{type(e).__name__}: {e}"))
+
+
+def run_worker(*args, **kwargs):
+    asyncio.run(AcquisitionWorker(*args, **kwargs).run())
+
+
+class RemoteBus:
+    """Station-side handle of a bus owned by a worker; bus methods become round trips to it."""
+
+    def __init__(self, scheduler: 'ShardedScheduler', port: str):
+        self.scheduler = scheduler
+        self.port = port
+
+    async def connect(self):
+        await self.scheduler.start()
+        return True
+
+    def disconnect(self):
+        self.scheduler.stop()
+
+    def __getattr__(self, method: str):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        async def call(*args):
+            return await self.scheduler.call(self.port, method, args)
+        return call
+
+
+class ShardedScheduler:
+    """PollScheduler stand-in that spreads the buses over worker threads or processes.
+
+    Each entry of ``groups`` is a list of ports polled by one worker; ports not
+    listed get a worker each. Workers poll on their own schedule and push
+    results, which ``poll_due`` hands to the station as they arrive.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, slot_ports: Dict[int, Tuple[str, float]], bus_config: Dict, groups: List[List[str]] = (),
+                 mode: str = 'process', serial_factory=aioserial.AioSerial, poll_timeout: float = 3,
+                 idle_interval: float = 10, call_timeout: float = 10, policy: Optional[PollPolicy] = None,
+                 capture_config: Optional[Dict] = None):
+        self.mode = mode
+        self.idle_interval = idle_interval
+        self.call_timeout = call_timeout
+        ports = list(dict.fromkeys([bus_config['port'], *(port for port, _ in slot_ports.values())]))
+        groups = [list(group) for group in groups]
+        grouped = {port for group in groups for port in group}
+        groups += [[port] for port in ports if port not in grouped]
+        self.port_worker = {port: n for n, group in enumerate(groups) for port in group}
+
+        queues = multiprocessing if mode == 'process' else queue
+        self.results = queues.Queue()
+        self.commands = [queues.Queue() for _ in groups]
+        self.workers = []
+        for n, group in enumerate(groups):
+            slots = {slot_id: (port, interval) for slot_id, (port, interval) in slot_ports.items() if port in group}
+            args = (f"worker-{n}", {port: {**bus_config, 'port': port} for port in group}, slots,
+                    self.results, self.commands[n], serial_factory, poll_timeout, idle_interval, policy,
+                    capture_config)
+            if mode == 'process':
+                self.workers.append(multiprocessing.Process(target=run_worker, args=args, daemon=True))
+            else:
+                self.workers.append(threading.Thread(target=run_worker, args=args, daemon=True))
+
+        self.buses = {port: RemoteBus(self, port) for port in ports}
+        self.slots = {slot_id: Slot(slot_id, self.buses[port], interval)
+                      for slot_id, (port, interval) in slot_ports.items()}
+        self.shared_buses = SharedBuses(self.slots)
+        self.on_result = None
+        self._utilisation: Dict[str, float] = {}
+        self._pending: Dict[int, Tuple[BmsSample, List[float]]] = {}
+        self._replies: Dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count()
+        self._reader: Optional[threading.Thread] = None
+        self._started = False
+        self._stopped = False
+
+    async def start(self):
+        if self._started:
+            return
+        self._started = True
+        self._reader = threading.Thread(target=pump, args=(self.results, asyncio.get_running_loop(), self._receive),
+                                        daemon=True)
+        self._reader.start()
+        for worker in self.workers:
+            worker.start()
+        self.logger.info(f"Started {len(self.workers)} acquisition {self.mode} workers")
+
+    def stop(self):
+        if not self._started or self._stopped:
+            return
+        self._stopped = True
+        for commands in self.commands:
+            commands.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.results.put(None)
+        self._reader.join(timeout=1)
+
+    def _receive(self, message):
+        if message is None:
+            return
+        if message[0] == 'samples':
+            _, results, rates, utilisation = message
+            now = time.monotonic()
+            self._utilisation.update(utilisation)
+            for slot_id, result in results.items():
+                slot = self.slots[slot_id]
+                if self.shared_buses.polled(slot):
+                    slot.record_poll(now)
+                    slot.target_interval = rates.get(slot_id, (slot.target_interval,))[0]
+                    self._pending[slot_id] = result
+            if self._pending and self.on_result:
+                self.on_result()
+        elif message[0] == 'reply':
+            _, request_id, result, error = message
+            future = self._replies.pop(request_id, None)
+            if future is None or future.done():
+                return
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    async def call(self, port: str, method: str, args: tuple):
+        await self.start()
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._replies[request_id] = future
+        self.commands[self.port_worker[port]].put(('call', request_id, port, method, args))
+        try:
+            return await asyncio.wait_for(future, self.call_timeout)
+        finally:
+            self._replies.pop(request_id, None)
+
+    def _send_occupied(self, slot_id: int, occupied: bool):
+        self.commands[self.port_worker[self.slots[slot_id].bms.port]].put(('occupied', slot_id, occupied))
+
+    def mark_occupied(self, slot_id: int):
+        self.slots[slot_id].occupied = True
+        self.shared_buses.select(self.slots[slot_id])
+        self._send_occupied(slot_id, True)
+
+    def mark_empty(self, slot_id: int):
+        slot = self.slots[slot_id]
+        slot.occupied = False
+        slot.last_poll = None
+        slot.achieved_interval = None
+        self.shared_buses.release(slot)
+        self._pending.pop(slot_id, None)
+        self._send_occupied(slot_id, False)
+
+    def occupied_slots(self) -> List[int]:
+        return [slot_id for slot_id, slot in self.slots.items() if slot.occupied]
+
+    def utilisation(self) -> Dict[str, float]:
+        return dict(self._utilisation)
+
+    def rates(self) -> Dict[int, Tuple[float, Optional[float]]]:
+        return {slot_id: (slot.target_interval, slot.achieved_interval)
+                for slot_id, slot in self.slots.items() if self.shared_buses.polled(slot)}
+
+    def time_until_next(self, now: Optional[float] = None) -> float:
+        # Workers wake the station through on_result, this is only the fallback
+        return 0.0 if self._pending else self.idle_interval
+
+    async def poll_due(self) -> Dict[int, Tuple[BmsSample, List[float]]]:
+        results, self._pending = self._pending, {}
+        return results
@@ -0,0 +1,170 @@
+import math
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from bms import BmsSample
+
+
+class Ewma:
+    """Exponentially weighted mean and variance, O(1) per update."""
+
+    __slots__ = ('alpha', 'mean', 'variance', 'count')
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.mean = math.nan
+        self.variance = 0.0
+        self.count = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return value
+        diff = value - self.mean
+        increment = self.alpha * diff
+        self.mean += increment
+        self.variance = (1 - self.alpha) * (self.variance + diff * increment)
+        return self.mean
+
+    def zscore(self, value: float, min_std: float = 0.0) -> float:
+        # Distance from the running mean in standard deviations, before value is added;
+        # min_std keeps sensor resolution noise on a flat signal from looking like a spike
+        std = max(math.sqrt(self.variance), min_std)
+        if self.count < 2 or std <= 0:
+            return 0.0
+        return (value - self.mean) / std
+
+
+class Alert:
+    __slots__ = ('slot_id', 'kind', 'active', 'value', 'detail', 'timestamp')
+
+    def __init__(self, slot_id: int, kind: str, active: bool, value: float, detail: str = '',
+                 timestamp: Optional[float] = None):
+        self.slot_id = slot_id
+        self.kind = kind
+        self.active = active
+        self.value = value
+        self.detail = detail
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class SlotAnalytics:
+    """Rolling statistics of one slot: pack current and temperature, and each cell's offset from the pack mean."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.current = Ewma(alpha)
+        self.temperature = Ewma(alpha)
+        self.cell_offsets: List[Ewma] = []
+        self.cell_min = math.nan
+        self.cell_max = math.nan
+        self.cell_delta = math.nan
+        self.active: Dict[str, bool] = {}
+
+    def update_cells(self, voltages: Sequence[float]) -> Tuple[int, float]:
+        # Returns the cell drifting furthest from the pack mean and its smoothed offset
+        if len(self.cell_offsets) != len(voltages):
+            self.cell_offsets = [Ewma(self.alpha) for _ in voltages]
+        low = high = voltages[0]
+        total = 0.0
+        for voltage in voltages:
+            total += voltage
+            if voltage < low:
+                low = voltage
+            elif voltage > high:
+                high = voltage
+        self.cell_min, self.cell_max, self.cell_delta = low, high, high - low
+        mean = total / len(voltages)
+        worst, worst_offset = 0, 0.0
+        for cell, (voltage, offset) in enumerate(zip(voltages, self.cell_offsets)):
+            smoothed = offset.update(voltage - mean)
+            if abs(smoothed) > abs(worst_offset):
+                worst, worst_offset = cell, smoothed
+        return worst, worst_offset
+
+
+class AnomalyDetector:
+    """Streaming imbalance and anomaly checks run on every poll.
+
+    Each check has a trigger and a lower release threshold, so an alert fires
+    once when the trigger is crossed and clears once the value falls back
+    below the release level instead of flapping around a single limit.
+    """
+
+    def __init__(self, alpha: float = 0.1, warmup: int = 10,
+                 imbalance: Tuple[float, float] = (0.1, 0.05), cell_drift: Tuple[float, float] = (0.05, 0.03),
+                 cell_low: Tuple[float, float] = (2.8, 2.9), cell_high: Tuple[float, float] = (3.65, 3.6),
+                 fan: Tuple[float, float] = (45, 40), over_temperature: Tuple[float, float] = (60, 50),
+                 zscore: Tuple[float, float] = (4, 2), min_std_temperature: float = 1.0,
+                 min_std_current: float = 1.0):
+        self.alpha = alpha
+        self.warmup = warmup
+        self.imbalance = imbalance
+        self.cell_drift = cell_drift
+        self.cell_low = cell_low
+        self.cell_high = cell_high
+        self.fan = fan
+        self.over_temperature = over_temperature
+        self.zscore = zscore
+        self.min_std_temperature = min_std_temperature
+        self.min_std_current = min_std_current
+        self.slots: Dict[int, SlotAnalytics] = {}
+
+    def reset(self, slot_id: int):
+        self.slots.pop(slot_id, None)
+
+    def _check(self, stats: SlotAnalytics, alerts: List[Alert], slot_id: int, kind: str, value: float,
+               limits: Tuple[float, float], detail: str = '', below: bool = False):
+        trigger, release = limits
+        active = stats.active.get(kind, False)
+        if below:
+            now_active = value < release if active else value < trigger
+        else:
+            now_active = value > release if active else value > trigger
+        if now_active != active:
+            stats.active[kind] = now_active
+            alerts.append(Alert(slot_id, kind, now_active, value, detail))
+
+    def update(self, slot_id: int, sample: BmsSample, voltages: Sequence[float]) -> List[Alert]:
+        # Alerts whose state changed with this poll
+        stats = self.slots.get(slot_id)
+        if stats is None:
+            stats = self.slots[slot_id] = SlotAnalytics(self.alpha)
+        alerts: List[Alert] = []
+
+        if voltages:
+            cell, offset = stats.update_cells(voltages)
+            self._check(stats, alerts, slot_id, 'cell_imbalance', stats.cell_delta, self.imbalance)
+            self._check(stats, alerts, slot_id, 'cell_drift', abs(offset), self.cell_drift, f"cell {cell + 1}")
+            self._check(stats, alerts, slot_id, 'cell_low', stats.cell_min, self.cell_low, below=True)
+            self._check(stats, alerts, slot_id, 'cell_high', stats.cell_max, self.cell_high)
+
+        if sample.mos_temperature:
+            temperature = max(sample.mos_temperature)
+            self._check(stats, alerts, slot_id, 'fan', temperature, self.fan)
+            self._check(stats, alerts, slot_id, 'over_temperature', temperature, self.over_temperature)
+            if stats.temperature.count >= self.warmup:
+                self._check(stats, alerts, slot_id, 'temperature_spike',
+                            abs(stats.temperature.zscore(temperature, self.min_std_temperature)), self.zscore)
+            stats.temperature.update(temperature)
+
+        if not math.isnan(sample.current):
+            if stats.current.count >= self.warmup:
+                self._check(stats, alerts, slot_id, 'current_spike',
+                            abs(stats.current.zscore(sample.current, self.min_std_current)), self.zscore)
+            stats.current.update(sample.current)
+        return alerts
+
+    def summary(self, slot_id: int) -> Optional[Dict]:
+        stats = self.slots.get(slot_id)
+        if stats is None:
+            return None
+        # NaN (no cell voltages or temperatures seen yet) becomes None so the summary serializes as JSON
+        values = {'cell_min': stats.cell_min, 'cell_max': stats.cell_max, 'cell_delta': stats.cell_delta,
+                  'current_ewma': stats.current.mean, 'temperature_ewma': stats.temperature.mean}
+        summary = {key: None if math.isnan(value) else value for key, value in values.items()}
+        summary['active'] = [kind for kind, active in stats.active.items() if active]
+        return summary
@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import statistics
+import time
+from math import isnan
+from typing import Dict, List
+import main as station_main
+from main import BssStation
+from bms import BmsSample
+from simulator import SimulatedStationHardware
+from swap import SlotState
+
+
+class RecordingSink:
+    """Sink replacement that records when fresh samples arrive instead of writing them."""
+
+    def __init__(self):
+        self.samples = 0
+        self.latencies: List[float] = []
+        self.arrivals: Dict[int, asyncio.Event] = {}
+        self._last_timestamp: Dict[int, float] = {}
+
+    def wait_for_slot(self, battery_id: int) -> asyncio.Event:
+        self.arrivals[battery_id] = asyncio.Event()
+        return self.arrivals[battery_id]
+
+    async def publish_sample(self, samples_dict: Dict[int, BmsSample]):
+        now = time.time()
+        for battery_id, sample in samples_dict.items():
+            if isnan(sample.voltage) or self._last_timestamp.get(battery_id) == sample.timestamp:
+                continue
+            self._last_timestamp[battery_id] = sample.timestamp
+            self.samples += 1
+            self.latencies.append(now - sample.timestamp)
+            if battery_id in self.arrivals:
+                self.arrivals.pop(battery_id).set()
+
+    async def publish_voltage(self, voltages_dict):
+        pass
+
+    async def close(self):
+        pass
+
+
+def make_config(num_slots: int, shared_bus: bool, baudrate: int, acquisition: str = 'inline',
+                bus_budget: float = 0) -> Dict:
+    slots = {} if shared_bus else {str(i): {'port': f'SIM_BMS{i}'} for i in range(1, 11)}
+    config = {
+        # max_soc 0 makes every pack ready, so a full station always has one to hand out
+        'battery_config': {'max_batteries': 10, 'poll_interval': 0, 'poll_timeout': 1, 'max_soc': 0, 'slots': slots},
+        'serial_battery_config': {'port': 'SIM_BMS', 'baudrate': baudrate, 'timeout': 1},
+        'serial_control_config': {'port': 'SIM_CONTROL', 'baudrate': 9600, 'timeout': 1},
+        'state_store_config': {'path': ':memory:'},
+        'compression_config': {'enabled': False},
+        'acquisition_config': {'mode': acquisition},
+    }
+    if bus_budget:
+        config['battery_config']['adaptive_polling'] = {'bus_budget': bus_budget}
+    return config
+
+
+def percentile(values: List[float], p: int) -> float:
+    if not values:
+        return float('nan')
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[p - 1]
+
+
+async def run(num_slots: int, duration: float, swaps: int, shared_bus: bool, baudrate: int,
+              acquisition: str = 'inline', bus_budget: float = 0) -> Dict:
+    station_main.shutdown = False
+    hardware = SimulatedStationHardware(control_port='SIM_CONTROL')
+    sink = RecordingSink()
+    station = BssStation(sink=sink, serial_factory=hardware, **make_config(num_slots, shared_bus, baudrate, acquisition, bus_budget))
+    for slot_id in range(1, num_slots + 1):
+        station.swaps.restore(slot_id, SlotState.CHARGING)
+        station.accept_battery(slot_id)
+
+    tasks = [asyncio.create_task(station.fetch_and_log_battery_loop()),
+             asyncio.create_task(station.listen_controllino())]
+    await asyncio.sleep(0.5)
+    start_samples, start = sink.samples, time.monotonic()
+    sink.latencies.clear()
+    await asyncio.sleep(duration)
+    throughput = (sink.samples - start_samples) / (time.monotonic() - start)
+    latencies = list(sink.latencies)
+
+    # Swap handling: free a slot, close its limit switch and time until its first sample reaches the sink
+    swap_latencies = []
+    for n in range(swaps):
+        slot_id = n % num_slots + 1
+        station.release_slot(slot_id)
+        station.swaps.restore(slot_id, SlotState.EMPTY)
+        arrived = sink.wait_for_slot(slot_id)
+        started = time.monotonic()
+        hardware.controllino.activate_switch(station.slot_to_relay(slot_id))
+        try:
+            await asyncio.wait_for(arrived.wait(), timeout=10)
+            swap_latencies.append(time.monotonic() - started)
+        except asyncio.TimeoutError:
+            station.logger.error(f"Swap into slot {slot_id} did not produce a sample")
+
+    station_main.shutdown = True
+    station.update_event.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for bms in station.buses.values():
+        bms.disconnect()
+    station.store.close()
+
+    return {
+        'slots': num_slots,
+        'samples_per_s': throughput,
+        'latency_ms': [percentile(latencies, p) * 1000 for p in (50, 95, 99)],
+        'swap_ms': [percentile(swap_latencies, p) * 1000 for p in (50, 95, 99)],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Acquisition path benchmark against simulated hardware")
+    parser.add_argument('--slots', type=int, nargs='+', default=[1, 2, 5, 10])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--swaps', type=int, default=5)
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--shared-bus', action='store_true', help="wire every slot to one simulated port, so only the pack inserted last is polled")
+    parser.add_argument('--acquisition', choices=['inline', 'thread'], default='inline',
+                        help="poll the buses on the station loop or on worker threads")
+    parser.add_argument('--bus-budget', type=float, default=0,
+                        help="enable adaptive polling, keeping each bus busy at most this fraction of the time")
+    args = parser.parse_args()
+
+    print(f"{'slots':>5} {'samples/s':>10} {'lat p50/p95/p99 ms':>24} {'swap p50/p95/p99 ms':>24}")
+    for num_slots in args.slots:
+        result = await run(num_slots, args.duration, args.swaps, args.shared_bus, args.baudrate, args.acquisition,
+                             args.bus_budget)
+        latency = '/'.join(f'{v:.1f}' for v in result['latency_ms'])
+        swap = '/'.join(f'{v:.0f}' for v in result['swap_ms'])
+        print(f"{result['slots']:>5} {result['samples_per_s']:>10.1f} {latency:>24} {swap:>24}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -4,36 +4,41 @@ import time
 
 
 class BmsSample:
-    def __init__(self, voltage=math.nan, current=math.nan, charge=math.nan, 
-                 num_cycles=None, soc=None, mos_temperature: Optional[List[float]] = None , 
-                 switches: Optional[Dict[str, bool]] = None):
+
+    __slots__ = ('voltage', 'current', 'charge', 'num_cycles', 'soc', 'mos_temperature', 'mos_state', 'timestamp')
+
+    def __init__(self, voltage=math.nan, current=math.nan, charge=math.nan,
+                 num_cycles=None, soc=None, mos_temperature: Optional[List[float]] = None ,
+                 switches: Optional[Dict[str, bool]] = None, mos_state: Optional[int] = None,
+                 timestamp: Optional[float] = None):
         self.voltage = float(voltage)
         self.current = float(current)
         self.charge = float(charge)
         self.num_cycles = int(num_cycles) if num_cycles is not None else None
-        self.soc = int(soc) if num_cycles is not None else None
-        self.mos_temperature = mos_temperature if mos_temperature is not None else []
-        self.switches = switches
-        self.timestamp = time.time()
+        self.soc = int(soc) if soc is not None else None
+        self.mos_temperature = tuple(mos_temperature) if mos_temperature is not None else ()
+        if switches is not None:
+            mos_state = (0x01 if switches.get('charge') else 0) | (0x02 if switches.get('discharge') else 0)
+        self.mos_state = mos_state
+        self.timestamp = time.time() if timestamp is None else timestamp
 
-    def __str__(self):
-        return str(vars(self))
-        
-    def to_dict(self):
-        result = {}
-        for key, value in vars(self).items():
-            if key == 'switches':
-                continue
-            if value is not None and not (isinstance(value, float) and math.isnan(value)):
-                result[key] = value
-        
-        if 'mos_temperature' in result:
-            mos_temps = result.pop('mos_temperature')
-            for i, temp in enumerate(mos_temps, start=1):
-                result[f'mos_temperature_{i}'] = temp
+    @property
+    def switches(self) -> Optional[Dict[str, bool]]:
+        if self.mos_state is None:
+            return None
+        return {'discharge': self.mos_state & 0x02 > 0, 'charge': self.mos_state & 0x01 > 0}
 
-        return result
-    
+    def __str__(self):
+        return str({key: getattr(self, key) for key in self.__slots__})
 
+    def fields(self):
+        # Flat (key, value) pairs of the populated fields, mos temperatures as mos_temperature_N
+        for key in ('voltage', 'current', 'charge', 'num_cycles', 'soc', 'timestamp'):
+            value = getattr(self, key)
+            if value is not None and not (isinstance(value, float) and math.isnan(value)):
+                yield key, value
+        for i, temp in enumerate(self.mos_temperature, start=1):
+            yield f'mos_temperature_{i}', temp
 
-    
+    def to_dict(self):
+        return dict(self.fields())
@@ -0,0 +1,254 @@
+import asyncio
+import glob
+import mmap
+import os
+import struct
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+from simulator import SimulatedSerial
+from util import get_logger
+
+MAGIC = b'BSSCAP1\n'
+# timestamp, direction, port index, length
+RECORD = struct.Struct('<dBBH')
+RX, TX, PORT = 0, 1, 2
+
+
+class CaptureLog:
+    """Append-only binary log of raw serial traffic, written through a memory-mapped segment.
+
+    Each record is a RECORD header followed by the bytes. Segments are preallocated
+    files of ``segment_size`` bytes; a full segment is trimmed and the next one
+    started, keeping at most ``max_files``. Every segment starts by naming the
+    ports it uses, so each file can be replayed on its own. Files are named
+    ``<prefix>-<time>-<sequence>.bin``; a log is written by one thread only, so
+    every acquisition worker has its own prefix.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, directory: str = 'captures', segment_size: int = 16 * 1024 * 1024, max_files: int = 20,
+                 prefix: str = 'capture'):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.max_files = max_files
+        self.ports: Dict[str, int] = {}
+        self._declared = set()
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        self._offset = 0
+        self._sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def wrap(self, serial_factory):
+        # A serial_factory whose ports record everything they read and write
+        def factory(port: str, **kwargs):
+            return CapturingSerial(serial_factory(port=port, **kwargs), self, port)
+        return factory
+
+    def files(self) -> List[str]:
+        # Timestamps start with a digit, so other prefixes sharing the directory are left alone
+        return sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}-[0-9]*.bin')))
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.directory, f"{self.prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{self._sequence:04d}.bin")
+        self._file = open(path, 'w+b')
+        self._file.truncate(self.segment_size)
+        self._map = mmap.mmap(self._file.fileno(), self.segment_size)
+        self._map[:len(MAGIC)] = MAGIC
+        self._offset = len(MAGIC)
+        self._declared = set()
+        for old in self.files()[:-self.max_files]:
+            os.remove(old)
+        self.logger.info(f"Capturing serial traffic to {path}")
+
+    def _close_segment(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        # Trim the unused preallocated tail
+        self._file.truncate(self._offset)
+        self._file.close()
+        self._map = self._file = None
+
+    def _write(self, direction: int, index: int, data, timestamp: float):
+        size = RECORD.size + len(data)
+        if self._map is None or self._offset + size > self.segment_size:
+            self._close_segment()
+            self._open_segment()
+        RECORD.pack_into(self._map, self._offset, timestamp, direction, index, len(data))
+        self._map[self._offset + RECORD.size:self._offset + size] = data
+        self._offset += size
+
+    def record(self, port: str, direction: int, data):
+        if not data:
+            return
+        timestamp = time.time()
+        index = self.ports.setdefault(port, len(self.ports))
+        for start in range(0, len(data), 0xFFFF):
+            if index not in self._declared or self._map is None:
+                self._write(PORT, index, port.encode(), timestamp)
+                self._declared.add(index)
+            self._write(direction, index, data[start:start + 0xFFFF], timestamp)
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        self._close_segment()
+
+
+class CapturingSerial:
+    """Wraps a serial port object and logs the bytes passing through it."""
+
+    def __init__(self, serial, log: CaptureLog, port: str):
+        self._serial = serial
+        self._log = log
+        self._port = port
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    async def write_async(self, data) -> int:
+        self._log.record(self._port, TX, data)
+        return await self._serial.write_async(data)
+
+    async def read_async(self, size: int = 1) -> bytes:
+        data = await self._serial.read_async(size)
+        self._log.record(self._port, RX, data)
+        return data
+
+    async def readline_async(self, size: int = -1) -> bytes:
+        data = await self._serial.readline_async(size)
+        self._log.record(self._port, RX, data)
+        return data
+
+
+def read_capture(path: str) -> Iterator[Tuple[float, int, str, bytes]]:
+    """(timestamp, direction, port, data) records of one capture file."""
+    ports: Dict[int, str] = {}
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        offset = len(MAGIC)
+        while offset + RECORD.size <= len(data):
+            timestamp, direction, index, length = RECORD.unpack_from(data, offset)
+            if timestamp == 0:
+                # Zeroed preallocated space left by an unclean shutdown
+                break
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            offset += RECORD.size + length
+            if direction == PORT:
+                ports[index] = payload.decode()
+            else:
+                yield timestamp, direction, ports.get(index, str(index)), payload
+
+
+class Exchange:
+    __slots__ = ('timestamp', 'request', 'replies')
+
+    def __init__(self, timestamp: float, request: Optional[bytes]):
+        self.timestamp = timestamp
+        self.request = request
+        self.replies: List[Tuple[float, bytes]] = []
+
+
+class ReplayDevice:
+    """Answers the station's writes on one port with the bytes recorded after the same request.
+
+    Received bytes that followed a request within ``reply_window`` seconds are
+    its reply; anything else (Controllino events) is unsolicited and is played
+    on the capture's own timeline by CaptureReplay.
+    """
+
+    def __init__(self, speed: float, lookahead: int = 16):
+        self.speed = speed
+        self.lookahead = lookahead
+        self.exchanges = deque()
+        self.unsolicited = deque()
+        self.answered = 0
+        self.unmatched = 0
+
+    def _delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed else 0
+
+    async def handle(self, serial: SimulatedSerial, data: bytes):
+        for n, exchange in enumerate(self.exchanges):
+            if n >= self.lookahead:
+                break
+            if exchange.request == data:
+                for _ in range(n + 1):
+                    self.exchanges.popleft()
+                break
+        else:
+            self.unmatched += 1
+            return
+        self.answered += 1
+        loop = asyncio.get_running_loop()
+        for timestamp, reply in exchange.replies:
+            loop.call_later(self._delay(timestamp - exchange.timestamp), serial.feed, reply)
+
+
+class CaptureReplay:
+    """serial_factory that plays capture files back to BssStation.
+
+    ``speed`` 1 is real time, larger values play faster and 0 as fast as the
+    station can consume it.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, paths: List[str], speed: float = 1, reply_window: float = 1.0):
+        self.speed = speed
+        self.devices: Dict[str, ReplayDevice] = {}
+        self.ports: Dict[str, SimulatedSerial] = {}
+        self.records = 0
+        self.start = None
+        self.end = None
+        last_request: Dict[str, Exchange] = {}
+        for path in paths:
+            for timestamp, direction, port, data in read_capture(path):
+                self.records += 1
+                # Files of different workers overlap in time
+                self.start = timestamp if self.start is None else min(self.start, timestamp)
+                self.end = timestamp if self.end is None else max(self.end, timestamp)
+                device = self.devices.setdefault(port, ReplayDevice(speed))
+                if direction == TX:
+                    last_request[port] = Exchange(timestamp, data)
+                    device.exchanges.append(last_request[port])
+                    continue
+                exchange = last_request.get(port)
+                if exchange is not None and timestamp - exchange.timestamp <= reply_window:
+                    exchange.replies.append((timestamp, data))
+                else:
+                    device.unsolicited.append((timestamp, data))
+
+    def __call__(self, port: str, baudrate: int = 9600, timeout: Optional[float] = 1, **kwargs) -> SimulatedSerial:
+        device = self.devices.setdefault(port, ReplayDevice(self.speed))
+        # No simulated wire time when replaying at full speed
+        serial = SimulatedSerial(device, port, baudrate if self.speed else 0, timeout)
+        self.ports[port] = serial
+        return serial
+
+    def pending(self) -> int:
+        return sum(len(device.exchanges) + len(device.unsolicited) for device in self.devices.values())
+
+    async def play_unsolicited(self):
+        # Unsolicited bytes of every port in capture order, on the capture's clock
+        events = sorted((timestamp, port, data) for port, device in self.devices.items()
+                        for timestamp, data in device.unsolicited)
+        started = time.monotonic()
+        for timestamp, port, data in events:
+            if self.speed:
+                await asyncio.sleep(max(0, (timestamp - self.start) / self.speed - (time.monotonic() - started)))
+            else:
+                await asyncio.sleep(0)
+            serial = self.ports.get(port)
+            if serial is not None:
+                serial.feed(data)
+            self.devices[port].unsolicited.popleft()
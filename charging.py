@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import math
+from typing import Dict, List, Optional, Tuple
+from history import StationHistory
+
+
+class ChargeEstimator:
+    """Per-slot time-to-full estimate from the last ``window`` seconds of the station history.
+
+    The mean charging current over the window against the capacity still
+    missing to ``target_soc`` gives the estimate; packs that don't report
+    remaining capacity fall back to the least-squares SOC slope.
+    """
+
+    FIELDS = ('timestamp', 'soc', 'current', 'charge')
+
+    def __init__(self, target_soc: float, history: StationHistory, window: float = 600, min_points: int = 3):
+        self.target_soc = target_soc
+        self.history = history
+        self.window = window
+        self.min_points = min_points
+
+    def _recent(self, slot_id: int) -> List[Tuple]:
+        # Polls that returned no SOC or current don't count towards the estimate
+        return [row for row in self.history[slot_id].recent(self.FIELDS, self.window)
+                if not (math.isnan(row[1]) or math.isnan(row[2]))]
+
+    def time_to_full(self, slot_id: int) -> float:
+        # Seconds until target_soc, 0 when already there and inf when it isn't charging
+        recent = self._recent(slot_id)
+        if not recent:
+            return math.inf
+        _, soc, _, charge = recent[-1]
+        if soc >= self.target_soc:
+            return 0.0
+        current = sum(point[2] for point in recent) / len(recent)
+        if current > 0 and soc > 0 and not math.isnan(charge):
+            capacity = charge * 100 / soc
+            return (self.target_soc - soc) / 100 * capacity / current * 3600
+        return self._slope_estimate(recent, soc)
+
+    def _slope_estimate(self, recent: List[Tuple], soc: float) -> float:
+        if len(recent) < self.min_points:
+            return math.inf
+        t0 = recent[0][0]
+        n = len(recent)
+        mean_t = sum(point[0] - t0 for point in recent) / n
+        mean_soc = sum(point[1] for point in recent) / n
+        variance = sum((point[0] - t0 - mean_t) ** 2 for point in recent)
+        if variance == 0:
+            return math.inf
+        slope = sum((point[0] - t0 - mean_t) * (point[1] - mean_soc) for point in recent) / variance
+        return (self.target_soc - soc) / slope if slope > 0 else math.inf
+
+
+class ReadyQueue:
+    """Indexed min-heap of slots by predicted time-to-full.
+
+    Updating a slot marks its old heap entry stale instead of searching the
+    heap; stale entries are skipped when the top is read.
+    """
+
+    REMOVED = None
+
+    def __init__(self):
+        self._heap: List[list] = []
+        self._entries: Dict[int, list] = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, slot_id: int) -> bool:
+        return slot_id in self._entries
+
+    def update(self, slot_id: int, eta: float):
+        entry = self._entries.get(slot_id)
+        if entry is not None:
+            if entry[0] == eta:
+                return
+            entry[2] = self.REMOVED
+        entry = [eta, next(self._counter), slot_id]
+        self._entries[slot_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, slot_id: int):
+        entry = self._entries.pop(slot_id, None)
+        if entry is not None:
+            entry[2] = self.REMOVED
+
+    def peek(self) -> Optional[Tuple[int, float]]:
+        # (slot_id, eta) of the pack expected to be ready first
+        heap = self._heap
+        while heap and heap[0][2] is self.REMOVED:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][2], heap[0][0]
+
+    def items(self) -> List[Tuple[int, float]]:
+        return sorted(((slot_id, entry[0]) for slot_id, entry in self._entries.items()), key=lambda item: item[1])
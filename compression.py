@@ -0,0 +1,77 @@
+import math
+import time
+from typing import Dict, List, Optional
+from bms import BmsSample
+
+
+class DeadbandFilter:
+    """Drops telemetry that hasn't moved since the last point sent for a slot.
+
+    A sample is emitted when any field changed by more than its deadband, when
+    the MOS state or cycle count changed, or when ``heartbeat`` seconds passed
+    since the last emitted point. Empty slots are never emitted.
+    """
+
+    DEFAULT_DEADBANDS = {'voltage': 0.05, 'current': 0.1, 'charge': 0.1, 'soc': 1, 'mos_temperature': 0.5}
+
+    def __init__(self, deadbands: Optional[Dict[str, float]] = None, cell_deadband: float = 0.005,
+                 heartbeat: float = 60, enabled: bool = True):
+        self.deadbands = {**self.DEFAULT_DEADBANDS, **(deadbands or {})}
+        self.cell_deadband = cell_deadband
+        self.heartbeat = heartbeat
+        self.enabled = enabled
+        self._samples: Dict[int, BmsSample] = {}
+        self._voltages: Dict[int, List[float]] = {}
+        self._voltage_times: Dict[int, float] = {}
+        self.received = 0
+        self.emitted = 0
+
+    def _moved(self, key: str, old, new) -> bool:
+        if old is None or new is None:
+            return old is not new
+        return abs(new - old) >= self.deadbands[key]
+
+    def sample_changed(self, last: BmsSample, sample: BmsSample) -> bool:
+        if sample.timestamp - last.timestamp >= self.heartbeat:
+            return True
+        if sample.mos_state != last.mos_state or sample.num_cycles != last.num_cycles:
+            return True
+        if any(self._moved(key, getattr(last, key), getattr(sample, key)) for key in ('voltage', 'current', 'charge', 'soc')):
+            return True
+        if len(sample.mos_temperature) != len(last.mos_temperature):
+            return True
+        return any(self._moved('mos_temperature', old, new) for old, new in zip(last.mos_temperature, sample.mos_temperature))
+
+    def filter_samples(self, samples: Dict[int, BmsSample]) -> Dict[int, BmsSample]:
+        result = {}
+        for battery_id, sample in samples.items():
+            if math.isnan(sample.voltage):
+                self._samples.pop(battery_id, None)
+                continue
+            last = self._samples.get(battery_id)
+            if last is sample:
+                continue
+            self.received += 1
+            if not self.enabled or last is None or self.sample_changed(last, sample):
+                self._samples[battery_id] = sample
+                result[battery_id] = sample
+                self.emitted += 1
+        return result
+
+    def filter_voltages(self, voltages: Dict[int, List[float]]) -> Dict[int, List[float]]:
+        now = time.time()
+        result = {}
+        for battery_id, cells in voltages.items():
+            if not cells:
+                self._voltages.pop(battery_id, None)
+                continue
+            last = self._voltages.get(battery_id)
+            if last is cells:
+                continue
+            if (not self.enabled or last is None or len(last) != len(cells)
+                    or now - self._voltage_times[battery_id] >= self.heartbeat
+                    or any(abs(new - old) >= self.cell_deadband for old, new in zip(last, cells))):
+                self._voltages[battery_id] = cells
+                self._voltage_times[battery_id] = now
+                result[battery_id] = cells
+        return result
@@ -0,0 +1,180 @@
+import asyncio
+import concurrent.futures
+import json
+import re
+import zlib
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect
+import uvicorn
+import influxdb_api
+from line_protocol import escape_tag
+from sinks import create_client, load_config
+from util import get_logger
+
+logger = get_logger(__name__)
+
+# The series key (measurement and tags) ends at the first unescaped space
+SERIES_END = re.compile(r'(?<!\\) ')
+TAG_SEPARATOR = re.compile(r'(?<!\\),')
+TAG_VALUE = re.compile(r'(?<!\\)=')
+
+
+def point_key(line: str) -> Tuple[str, str]:
+    # (measurement+tags, timestamp): the tags carry station and battery_id
+    return SERIES_END.split(line, 1)[0], line.rsplit(' ', 1)[1]
+
+
+def series_tags(series: str) -> List[Tuple[str, str]]:
+    # (key, value) pairs of a series key's tags, both still escaped
+    tags = []
+    for tag in TAG_SEPARATOR.split(series)[1:]:
+        key, value = (TAG_VALUE.split(tag, 1) + [''])[:2]
+        tags.append((key, value))
+    return tags
+
+
+class DedupIndex:
+    """Bounded set of recently written point keys, oldest evicted first."""
+
+    def __init__(self, maxsize: int = 200000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys
+
+    def add(self, key):
+        self._keys[key] = None
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+
+class GatewayWriter:
+    """A small pool of database clients draining one queue of station batches.
+
+    Each worker merges whatever batches are waiting (up to batch_size lines) into
+    one write, then resolves every batch's future with the outcome.
+    """
+
+    def __init__(self, sink_config: Dict, pool_size: int = 4, batch_size: int = 5000, max_pending: int = 100):
+        self.sink_config = sink_config
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+        self.workers: List[asyncio.Task] = []
+
+    async def start(self):
+        for _ in range(self.pool_size):
+            self.workers.append(asyncio.create_task(self._worker(create_client(self.sink_config))))
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers.clear()
+
+    async def write(self, lines: List[str]):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((lines, future))
+        await future
+
+    async def _worker(self, client):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            size = len(items[0][0])
+            while size < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                size += len(items[-1][0])
+            record = [line for lines, _ in items for line in lines]
+            try:
+                await loop.run_in_executor(self.executor, partial(client.write, record=record))
+                for _, future in items:
+                    if not future.done():
+                        future.set_result(None)
+            except Exception as e:
+                logger.error(f"Gateway write of {len(record)} points failed: {e}")
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+class Gateway:
+
+    def __init__(self, server_config: Dict, sink_config: Dict):
+        self.tokens: Dict[str, str] = server_config.get('tokens', {})
+        self.dedup = DedupIndex(server_config.get('dedup_size', 200000))
+        self.writer = GatewayWriter(sink_config,
+                                    pool_size=server_config.get('pool_size', 4),
+                                    batch_size=server_config.get('batch_size', 5000))
+
+    def authorized(self, station: str, token: str) -> bool:
+        return not self.tokens or self.tokens.get(station) == token
+
+    async def ingest(self, station: str, payload: bytes) -> Dict:
+        station_tag = [escape_tag(station)]
+        fresh, keys = [], []
+        duplicates = rejected = 0
+        batch_keys = set()
+        for line in zlib.decompress(payload).decode().splitlines():
+            if not line:
+                continue
+            key = point_key(line)
+            if [value for tag, value in series_tags(key[0]) if tag == 'station'] != station_tag:
+                rejected += 1
+                continue
+            if key in self.dedup or key in batch_keys:
+                duplicates += 1
+                continue
+            batch_keys.add(key)
+            fresh.append(line)
+            keys.append(key)
+
+        if fresh:
+            await self.writer.write(fresh)
+            # Only written points count as seen, so a failed batch is accepted again on retry
+            for key in keys:
+                self.dedup.add(key)
+        return {'ok': True, 'written': len(fresh), 'duplicates': duplicates, 'rejected': rejected}
+
+
+router = APIRouter()
+gateway: Optional[Gateway] = None
+
+
+@router.websocket('/ingest')
+async def ingest_endpoint(websocket: WebSocket, station: str, token: str = ''):
+    if not gateway.authorized(station, token):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    logger.info(f"Station {station} connected")
+    try:
+        while True:
+            payload = await websocket.receive_bytes()
+            try:
+                ack = await gateway.ingest(station, payload)
+            except Exception as e:
+                ack = {'ok': False, 'error': str(e)}
+            await websocket.send_text(json.dumps(ack))
+    except WebSocketDisconnect:
+        logger.info(f"Station {station} disconnected")
+
+
+def create_app(config: Dict) -> FastAPI:
+    # Gateway mode is the regular API app plus the /ingest endpoint and a shared writer pool
+    global gateway
+    gateway = Gateway(config.get('gateway_server_config', {}), config['sink_config'])
+    app = influxdb_api.app
+    app.include_router(router)
+    app.add_event_handler('startup', gateway.writer.start)
+    app.add_event_handler('shutdown', gateway.writer.stop)
+    return app
+
+
+if __name__ == '__main__':
+    config = load_config()
+    server_config = config.get('gateway_server_config', {})
+    uvicorn.run(create_app(config), host=server_config.get('host', '0.0.0.0'), port=server_config.get('port', 8100))
@@ -0,0 +1,144 @@
+import math
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from bms import BmsSample
+
+
+class SlotHistory:
+    """Columnar ring of samples and cell voltages for one slot, holding up to ``capacity`` rows.
+
+    Every field is an ``array``; cell voltages and temperatures are stored as
+    float32 in row-major blocks. Storage starts at ``initial_size`` rows and
+    doubles as rows arrive, so empty and short-lived slots stay small.
+    """
+
+    FIELDS = ('timestamp', 'voltage', 'current', 'charge', 'soc', 'num_cycles')
+
+    def __init__(self, capacity: int = 86400, max_cells: int = 24, max_temps: int = 4, initial_size: int = 64):
+        self.capacity = capacity
+        self.max_cells = max_cells
+        self.max_temps = max_temps
+        self.initial_size = min(initial_size, capacity)
+        self.clear()
+
+    def clear(self):
+        # Drops every row and gives the memory back, e.g. when the slot's pack leaves
+        size = self.size = self.initial_size
+        self.columns: Dict[str, array] = {field: array('d', [math.nan]) * size for field in self.FIELDS}
+        self.num_cells = array('B', bytes(size))
+        self.num_temps = array('B', bytes(size))
+        self.cells = array('f', [math.nan]) * (size * self.max_cells)
+        self.temperatures = array('f', [math.nan]) * (size * self.max_temps)
+        self.mos_state = array('b', [-1]) * size
+        self.head = 0
+        self.count = 0
+
+    def _grow(self):
+        # Only called while the ring hasn't wrapped, so the rows are 0..count-1 and stay in place
+        extra = min(self.size * 2, self.capacity) - self.size
+        for column in self.columns.values():
+            column.extend(array('d', [math.nan]) * extra)
+        self.num_cells.extend(bytes(extra))
+        self.num_temps.extend(bytes(extra))
+        self.cells.extend(array('f', [math.nan]) * (extra * self.max_cells))
+        self.temperatures.extend(array('f', [math.nan]) * (extra * self.max_temps))
+        self.mos_state.extend(array('b', [-1]) * extra)
+        self.size += extra
+        self.head = self.count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sample: BmsSample, voltages: Iterable[float] = ()):
+        self.append_values(sample.timestamp, sample.voltage, sample.current, sample.charge, sample.soc,
+                           sample.num_cycles, sample.mos_state, sample.mos_temperature, voltages)
+
+    def append_values(self, timestamp: float, voltage: float, current: float, charge: float, soc: Optional[float],
+                      num_cycles: Optional[float], mos_state: Optional[int], temperatures=(), voltages: Iterable[float] = ()):
+        # Row append from plain values, used by decoders that skip building a BmsSample
+        if self.count == self.size < self.capacity:
+            self._grow()
+        i = self.head
+        columns = self.columns
+        columns['timestamp'][i] = timestamp
+        columns['voltage'][i] = voltage
+        columns['current'][i] = current
+        columns['charge'][i] = charge
+        columns['soc'][i] = math.nan if soc is None else soc
+        columns['num_cycles'][i] = math.nan if num_cycles is None else num_cycles
+        self.mos_state[i] = -1 if mos_state is None else mos_state
+
+        temps = temperatures[:self.max_temps]
+        self.num_temps[i] = len(temps)
+        self.temperatures[i * self.max_temps:i * self.max_temps + len(temps)] = array('f', temps)
+
+        n = 0
+        base = i * self.max_cells
+        for n, voltage in enumerate(voltages, start=1):
+            if n > self.max_cells:
+                n = self.max_cells
+                break
+            self.cells[base + n - 1] = voltage
+        self.num_cells[i] = n
+
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def _index(self, position: int) -> int:
+        # position 0 is the oldest stored row, -1 the newest
+        if not -self.count <= position < self.count:
+            raise IndexError(position)
+        if position < 0:
+            position += self.count
+        return (self.head - self.count + position) % self.size
+
+    def sample(self, position: int = -1) -> BmsSample:
+        i = self._index(position)
+        columns = self.columns
+        soc = columns['soc'][i]
+        num_cycles = columns['num_cycles'][i]
+        mos_state = self.mos_state[i]
+        return BmsSample(voltage=columns['voltage'][i],
+                         current=columns['current'][i],
+                         charge=columns['charge'][i],
+                         num_cycles=None if math.isnan(num_cycles) else num_cycles,
+                         soc=None if math.isnan(soc) else soc,
+                         mos_temperature=self.temperatures[i * self.max_temps:i * self.max_temps + self.num_temps[i]],
+                         mos_state=None if mos_state < 0 else mos_state,
+                         timestamp=columns['timestamp'][i])
+
+    def voltages(self, position: int = -1) -> array:
+        i = self._index(position)
+        return self.cells[i * self.max_cells:i * self.max_cells + self.num_cells[i]]
+
+    def recent(self, fields: Sequence[str], seconds: float) -> List[Tuple]:
+        # Rows of the given fields from the last ``seconds`` before the newest row, oldest first
+        if not self.count:
+            return []
+        columns = [self.columns[field] for field in fields]
+        timestamps = self.columns['timestamp']
+        i = self._index(-1)
+        cutoff = timestamps[i] - seconds
+        rows = []
+        for _ in range(self.count):
+            if timestamps[i] < cutoff:
+                break
+            rows.append(tuple(column[i] for column in columns))
+            i = (i - 1) % self.size
+        rows.reverse()
+        return rows
+
+
+class StationHistory:
+
+    def __init__(self, slot_ids: Iterable[int], capacity: int = 86400, max_cells: int = 24, max_temps: int = 4):
+        self.slots: Dict[int, SlotHistory] = {slot_id: SlotHistory(capacity, max_cells, max_temps) for slot_id in slot_ids}
+
+    def __getitem__(self, slot_id: int) -> SlotHistory:
+        return self.slots[slot_id]
+
+    def append(self, slot_id: int, sample: BmsSample, voltages: Iterable[float] = ()):
+        self.slots[slot_id].append(sample, voltages)
+
+    def clear(self, slot_id: int):
+        self.slots[slot_id].clear()
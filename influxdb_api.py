@@ -1,7 +1,16 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from metrics import REGISTRY
 from sinks import InfluxDBSink
+from telemetry import LiveTelemetry
+from util import TTLCache
+from typing import Optional
 import asyncio
+import concurrent.futures
+import math
+import re
+import time
 
 app = FastAPI()
 app.add_middleware(
@@ -13,27 +22,194 @@ app.add_middleware(
 )
 
 
-sink = InfluxDBSink()
+sink = None
+telemetry = LiveTelemetry()
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+POLL_INTERVAL = 5
+
+SAMPLE_FIELD = re.compile(r'^(voltage|current|charge|soc|mos_temperature_\d+)$')
+# Bucket sizes in seconds; the smallest one giving at most MAX_POINTS buckets over the window is used
+BUCKETS = (1, 10, 30, 60, 300, 900, 3600, 6 * 3600, 86400)
+MAX_POINTS = 500
+MAX_WINDOW = 90 * 86400
+history_cache = TTLCache(maxsize=256, ttl=30)
+app.state.station = None
+app.state.poller = None
+
+def attach_station(station):
+    # Embedded mode: share the station's sink and live state instead of opening a second client
+    global sink, telemetry
+    sink = station.sink
+    telemetry = station.telemetry
+    app.state.station = station
+
+def get_sink() -> InfluxDBSink:
+    global sink
+    if sink is None:
+        sink = InfluxDBSink()
+    return sink
+
+def query_client():
+    # Stations sending to a gateway have no database client of their own
+    client = getattr(get_sink(), 'client', None)
+    if client is None:
+        raise HTTPException(status_code=503, detail="No database client in this process")
+    return client
+
+@app.on_event("startup")
+async def start_poller():
+    # Standalone mode (uvicorn influxdb_api:app) has no station feeding the cache, so poll the database
+    if app.state.station is None:
+        app.state.poller = asyncio.create_task(poll_database())
+
+@app.on_event("shutdown")
+async def stop_poller():
+    if app.state.poller:
+        app.state.poller.cancel()
+
+async def poll_database():
+    # One shared query for all websocket clients; subscribers only get a push when the data changed
+    while True:
+        if telemetry.subscribers:
+            try:
+                telemetry.publish(await fetch_data())
+            except Exception as e:
+                print(f"An error occurred: {e}")
+        await asyncio.sleep(POLL_INTERVAL)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/summary")
+async def metrics_summary():
+    # Rolling-window percentiles of every histogram
+    return REGISTRY.summary()
+
+@app.get("/slots/estimates")
+async def slot_estimates():
+    # Predicted seconds until each charging pack is ready, soonest first
+    station = app.state.station
+    if station is None:
+        raise HTTPException(status_code=503, detail="No station attached")
+    return [{'battery_id': slot_id, 'seconds_to_full': None if math.isinf(eta) else round(eta)}
+            for slot_id, eta in station.swaps.estimates()]
+
+@app.get("/alerts")
+async def recent_alerts(active: bool = False):
+    station = app.state.station
+    if station is None:
+        raise HTTPException(status_code=503, detail="No station attached")
+    alerts = [alert.to_dict() for alert in station.alerts]
+    if active:
+        # Latest state per slot and kind, keeping only the ones still raised
+        latest = {(alert['slot_id'], alert['kind']): alert for alert in alerts}
+        alerts = [alert for alert in latest.values() if alert['active']]
+    return alerts
+
+@app.get("/slots/{battery_id}/analytics")
+async def slot_analytics(battery_id: int):
+    # Running cell spread and current/temperature baselines the anomaly detector compares against
+    station = app.state.station
+    if station is None:
+        raise HTTPException(status_code=503, detail="No station attached")
+    summary = station.analytics.summary(battery_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail=f"No samples for battery {battery_id}")
+    return summary
+
+@app.get("/swaps/history")
+async def swap_history(limit: int = 100):
+    # Most recent slot transitions first, from the local state store
+    station = app.state.station
+    if station is None:
+        raise HTTPException(status_code=503, detail="No station attached")
+    if not 0 < limit <= 10000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 10000")
+    return [{'battery_id': slot_id, 'state': state, 'at': at}
+            for slot_id, state, at in station.store.swap_history(limit)]
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    queue = telemetry.subscribe()
     try:
         while True:
-            data = await fetch_data()
-            await websocket.send_json({"data": data})
-            await asyncio.sleep(5)
+            payload = await queue.get()
+            await websocket.send_text(payload)
     except WebSocketDisconnect:
         print("WebSocket client disconnected")
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        telemetry.unsubscribe(queue)
 
 async def fetch_data():
     query = '''SELECT * FROM "sample" WHERE time >= now() - interval '7 days' ORDER BY time DESC LIMIT 10'''
     loop = asyncio.get_running_loop()
-    table = await loop.run_in_executor(None, lambda: sink.client.query(query))
-    data = remove_timestamp(table.to_pylist())
+    client = query_client()
+    table = await loop.run_in_executor(query_executor, lambda: client.query(query))
+    data = remove_timestamp(table).to_pylist()
     return data
 
-def remove_timestamp(data):
-    return [{k: v for k, v in item.items() if k != 'time'} for item in data]
+def remove_timestamp(table):
+    return table.select([name for name in table.column_names if name != 'time'])
+
+def choose_bucket(window: int) -> int:
+    for bucket in BUCKETS:
+        if window / bucket <= MAX_POINTS:
+            return bucket
+    return BUCKETS[-1]
+
+def table_to_columns(table) -> dict:
+    # Columnar JSON: one list per column, the bucket timestamps as epoch milliseconds;
+    # the query client already loaded pyarrow by the time a table exists
+    import pyarrow as pa
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name)
+        if pa.types.is_timestamp(column.type):
+            column = column.cast(pa.timestamp('ms')).cast(pa.int64())
+        columns[name] = column.to_pylist()
+    return columns
+
+async def query_history(measurement: str, field: str, battery_id: int, window: int, end: Optional[int]):
+    if not 0 < window <= MAX_WINDOW:
+        raise HTTPException(status_code=400, detail=f"window must be between 1 and {MAX_WINDOW} seconds")
+    bucket = choose_bucket(window)
+    # Align the range to the bucket so repeated requests for the same zoom level share a cache entry
+    live = end is None
+    end = int(time.time() if live else end)
+    end -= end % bucket
+    start = end - window
+    key = (battery_id, measurement, field, window, bucket, None if live else end)
+    result = history_cache.get(key)
+    if result is not None:
+        return result
+
+    query = f'''SELECT date_bin(INTERVAL '{bucket} seconds', time) AS time,
+                       avg("{field}") AS mean, min("{field}") AS min, max("{field}") AS max
+                FROM "{measurement}"
+                WHERE battery_id = '{battery_id}'
+                  AND time >= to_timestamp_seconds({start}) AND time < to_timestamp_seconds({end + bucket})
+                GROUP BY 1 ORDER BY 1'''
+    loop = asyncio.get_running_loop()
+    client = query_client()
+    table = await loop.run_in_executor(query_executor, lambda: client.query(query))
+    result = {"battery_id": battery_id, "field": field, "start": start, "end": end, "bucket": bucket,
+              **table_to_columns(table)}
+    # Closed ranges never change, live ones are refreshed once per bucket
+    history_cache.set(key, result, ttl=min(bucket, 60) if live else 3600)
+    return result
+
+@app.get("/history/{battery_id}/{field}")
+async def battery_history(battery_id: int, field: str, window: int = 3600, end: Optional[int] = None):
+    if not SAMPLE_FIELD.match(field):
+        raise HTTPException(status_code=404, detail=f"Unknown field {field}")
+    return await query_history("sample", field, battery_id, window, end)
+
+@app.get("/history/{battery_id}/cells/{cell}")
+async def cell_history(battery_id: int, cell: int, window: int = 3600, end: Optional[int] = None):
+    if cell < 1:
+        raise HTTPException(status_code=404, detail=f"Unknown cell {cell}")
+    return await query_history("voltage", f"cell{cell}", battery_id, window, end)
@@ -1,24 +1,193 @@
 
 import asyncio
+import struct
+import aioserial
 from serial_conn import SerialConnection
 from bms import BmsSample
-import copy
-from typing import List
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from util import get_logger
+from metrics import FRAME_ERRORS
+from modbus import crc_ok, write_coils_frame
 
 
 def is_empty_bytearray(result):
     return result == bytearray()
 
 
+def jbd_checksum(payload) -> int:
+    return (0x10000 - sum(payload)) & 0xFFFF
+
+
+# 0x03 payload up to the temperature list: voltage, current, remaining and nominal
+# capacity, cycles, (date, balance, protection, version), soc, mos, cells, ntc count
+BASIC_INFO = struct.Struct('>HhHHH9xBBBB')
+_WORDS: Dict[int, struct.Struct] = {}
+
+
+def _words(count: int) -> struct.Struct:
+    # Big-endian uint16 arrays, one precompiled Struct per length
+    words = _WORDS.get(count)
+    if words is None:
+        words = _WORDS[count] = struct.Struct(f'>{count}H')
+    return words
+
+
+def unpack_basic(buf, offset: int, length: int) -> Optional[Tuple]:
+    # (voltage, current, charge, soc, num_cycles, mos_state, temperatures) read in place from buf
+    if length < BASIC_INFO.size:
+        return None
+    voltage, current, charge, _, num_cycles, soc, mos_byte, _, num_temp = BASIC_INFO.unpack_from(buf, offset)
+    num_temp = min(num_temp, (length - BASIC_INFO.size) // 2)
+    raw_temps = _words(num_temp).unpack_from(buf, offset + BASIC_INFO.size)
+    return (voltage / 100, current / 100, charge / 100, soc, num_cycles, mos_byte & 0x03,
+            [(t - 2731) / 10 for t in raw_temps])
+
+
+def decode_basic(buf, offset: int = 0, length: Optional[int] = None, timestamp: Optional[float] = None) -> BmsSample:
+    values = unpack_basic(buf, offset, len(buf) - offset if length is None else length)
+    if values is None:
+        return BmsSample()
+    voltage, current, charge, soc, num_cycles, mos_state, temps = values
+    return BmsSample(voltage=voltage, current=current, charge=charge, soc=soc, num_cycles=num_cycles,
+                     mos_temperature=temps, mos_state=mos_state, timestamp=timestamp)
+
+
+def decode_cells(buf, offset: int = 0, length: Optional[int] = None) -> List[float]:
+    count = (len(buf) - offset if length is None else length) // 2
+    return [mv / 1000 for mv in _words(count).unpack_from(buf, offset)]
+
+
+class JbdFrameDecoder:
+    """Incremental decoder for JBD frames: 0xDD, cmd, status, length, data, checksum(2), 0x77.
+
+    Bytes are fed as they arrive from the port; complete frames are handed out as
+    memoryviews into the receive buffer, which is swapped out rather than copied.
+    """
+
+    HEADER = 0xDD
+    TRAILER = 0x77
+    HEAD_SIZE = 4
+    OVERHEAD = 7
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.checksum_errors = 0
+        self.resyncs = 0
+
+    def reset(self):
+        self._buffer = bytearray()
+
+    def bytes_needed(self) -> int:
+        size = len(self._buffer)
+        if size < self.HEAD_SIZE:
+            return self.HEAD_SIZE - size
+        return max(1, self._buffer[3] + self.OVERHEAD - size)
+
+    def _valid(self, buf, start: int, end: int) -> bool:
+        if buf[end - 1] != self.TRAILER:
+            return False
+        view = memoryview(buf)
+        valid = jbd_checksum(view[start + 2:end - 3]) == int.from_bytes(view[end - 3:end - 1], 'big')
+        view.release()
+        if not valid:
+            self.checksum_errors += 1
+            FRAME_ERRORS.inc(kind='checksum')
+        return valid
+
+    def feed(self, data) -> List[memoryview]:
+        buf = self._buffer
+        buf += data
+        size = len(buf)
+        frames = []
+        pos = 0
+        while True:
+            start = buf.find(self.HEADER, pos)
+            if start < 0:
+                pos = size
+                break
+            if size - start < self.HEAD_SIZE:
+                pos = start
+                break
+            end = start + buf[start + 3] + self.OVERHEAD
+            if end > size:
+                pos = start
+                break
+            if not self._valid(buf, start, end):
+                # Not a frame after all, resynchronise on the next header byte
+                self.resyncs += 1
+                FRAME_ERRORS.inc(kind='resync')
+                pos = start + 1
+                continue
+            frames.append((start, end))
+            pos = end
+
+        if not frames:
+            if pos:
+                del buf[:pos]
+            return []
+
+        self._buffer = buf[pos:]
+        view = memoryview(buf)
+        return [view[start:end] for start, end in frames]
+
+
+def decode_stream(chunks: Iterable[Tuple[float, bytes]]) -> Iterator[Tuple[float, int, object]]:
+    """Bulk-decode recorded (timestamp, bytes) chunks of one port into (timestamp, command, sample or voltages).
+
+    Frames may span chunks, so one decoder is kept for the whole stream; each
+    frame takes the timestamp of the chunk that completed it.
+    """
+    decoder = JbdFrameDecoder()
+    for timestamp, data in chunks:
+        for frame in decoder.feed(data):
+            if frame[2] != 0x00:
+                continue
+            if frame[1] == 0x03:
+                yield timestamp, 0x03, decode_basic(frame, 4, frame[3], timestamp)
+            elif frame[1] == 0x04:
+                yield timestamp, 0x04, decode_cells(frame, 4, frame[3])
+
+
+def decode_stream_into(history, chunks: Iterable[Tuple[float, bytes]]) -> int:
+    # Each basic-info frame becomes one history row, with the cell voltages of the frame that follows it;
+    # values go straight into the history columns without building a BmsSample
+    pending = None
+    rows = 0
+    decoder = JbdFrameDecoder()
+    for timestamp, data in chunks:
+        for frame in decoder.feed(data):
+            if frame[2] != 0x00:
+                continue
+            if frame[1] == 0x03:
+                if pending is not None:
+                    history.append_values(*pending)
+                    rows += 1
+                values = unpack_basic(frame, 4, frame[3])
+                pending = None if values is None else (timestamp, *values)
+            elif frame[1] == 0x04 and pending is not None:
+                history.append_values(*pending, decode_cells(frame, 4, frame[3]))
+                rows += 1
+                pending = None
+    if pending is not None:
+        history.append_values(*pending)
+        rows += 1
+    return rows
+
+
 class JbdBms(SerialConnection):
 
     logger = get_logger(__name__)
 
-    def __init__(self, port='COM9', baudrate = 9600, timeout=1):
-        super().__init__(port, baudrate, timeout)
-        self._buffer = bytearray()
-        self._switches = {'charge': False, 'discharge': False}
+    COMMAND_TIMEOUTS = {0x03: 1.0, 0x04: 1.0, 0xE1: 2.0}
+    MODBUS_TIMEOUT = 0.5
+    # Well below every command timeout, so a read cut short by one returns soon after
+    READ_TIMEOUT = 0.1
+
+    def __init__(self, port='COM9', baudrate = 9600, timeout=1, serial_factory=aioserial.AioSerial):
+        super().__init__(port, baudrate, timeout, serial_factory)
+        self._decoder = JbdFrameDecoder()
+        self._frames = deque()
         self._last_response = None
 
     async def connect(self):
@@ -33,118 +202,102 @@ class JbdBms(SerialConnection):
         return bytes([0xDD, 0xA5,command, 0x00, 0xFF, 0xFF - (command - 1), 0x77])
     
 
-    async def read_serial_data(self):
-        self._buffer += await self.serial.read_async(100)
-        self._last_response = copy.copy(self._buffer)
-        self._buffer.clear()
-
+    @staticmethod
+    def JbdBms_checksum(cmd, data):
+        return jbd_checksum(data + bytes([len(data), cmd])).to_bytes(2, byteorder='big')
 
-    async def _q(self,cmd,):
-        await self.serial.write_async(self.JbdBms_command(cmd))
-        await self.read_serial_data()
+    @staticmethod
+    def JbdBms_message(status_bit, cmd, data):
+        return bytes([0xDD, status_bit, cmd, len(data)]) + data + JbdBms.JbdBms_checksum(cmd, data) + bytes([0x77])
+
+
+    async def read_serial_data(self) -> memoryview:
+        # Read exactly what the decoder needs so a complete frame returns without waiting for the port timeout;
+        # the port timeout is short, so this keeps reading until the transaction timeout cancels it
+        while not self._frames:
+            chunk = await self.serial.read_async(self._decoder.bytes_needed())
+            if chunk:
+                self._frames.extend(self._decoder.feed(chunk))
+        self._last_response = self._frames.popleft()
         return self._last_response
 
-        
-    async def fetch_basic(self) -> BmsSample:
-
-        buf = await self._q(cmd=0x03)
-        if buf:
-            buf = buf[4:]
-            num_temp = int.from_bytes(buf[22:23], 'big')
-
-            mos_byte = int.from_bytes(buf[20:21], 'big')
+    async def read_exactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            data += await self.serial.read_async(size - len(data))
+        return data
+
+
+    def reset_input(self):
+        super().reset_input()
+        self._frames.clear()
+        self._decoder.reset()
+
+    async def read_response(self, key):
+        # JBD commands are matched by command byte, Modbus requests by (address, function, reply length)
+        if isinstance(key, tuple):
+            address, function, length = key
+            # Exception replies are 5 bytes, so read those first and only then the rest
+            reply = await self.read_exactly(min(length, 5))
+            if len(reply) == 5 and reply[1] == function | 0x80:
+                self.logger.warning(f"Modbus exception {reply[2]:#04x} from module {address:#04x}")
+                return None
+            if length > 5:
+                reply += await self.read_exactly(length - 5)
+            if len(reply) == length and reply[0] == address and reply[1] == function and crc_ok(reply):
+                return reply
+            return None
+        while True:
+            frame = await self.read_serial_data()
+            if frame[1] == key:
+                return frame
+            self.logger.warning(f"Discarding response to command {frame[1]:#04x}")
 
-            Sample = BmsSample(
-                voltage = float(int.from_bytes(buf[0:2], byteorder='big', signed=False)) / 100,
-                current = float(int.from_bytes(buf[2:4], byteorder='big', signed=True)) / 100,
-                charge=int.from_bytes(buf[4:6], byteorder='big', signed=False) / 100,
-                #capacity=int.from_bytes(buf[6:8], byteorder='big', signed=False) / 100,
-                soc=int.from_bytes(buf[19:20],byteorder='big', signed=False),
 
-                num_cycles=int.from_bytes(buf[8:10], byteorder='big', signed=False),
-
-                mos_temperature =[(int.from_bytes(buf[23 + i * 2:i * 2 + 25], 'big') - 2731) / 10 for i in range(num_temp)],
-
-                switches = {
-                            'discharge': mos_byte & 0x02 > 0,
-                            'charge': mos_byte & 0x01 > 0}
+    async def _q(self,cmd,):
+        return await self.transact(self.JbdBms_command(cmd), key=cmd, timeout=self.COMMAND_TIMEOUTS.get(cmd))
 
-            )
-            
-            return Sample
+    async def probe(self) -> bool:
+        return await self._q(cmd=0x03) is not None
 
-        else:
-            return BmsSample()
         
+    async def fetch_basic(self) -> BmsSample:
+        frame = await self._q(cmd=0x03)
+        if frame is None or frame[2] != 0x00:
+            return BmsSample()
+        return decode_basic(frame, 4, frame[3])
 
     async def fetch_voltages(self) -> List[float]:
-        buf = await self._q(cmd=0x04)
-        num_cell = int(buf[3] // 2)
-        voltages = list(map(float, [(int.from_bytes(buf[4 + i * 2: 6 + i * 2], 'big') / 1000) for i in range(num_cell)]))
-        
-        return voltages
-
+        frame = await self._q(cmd=0x04)
+        if frame is None or frame[2] != 0x00:
+            return []
+        return decode_cells(frame, 4, frame[3])
 
-    async def set_switch(self, switch: str, state: bool ):
 
+    async def set_switch(self, switch: str, state: bool, switches: Optional[Dict[str, bool]] = None):
+        # 0xE1 sets both MOSFETs at once, so the other one keeps the pack's current state;
+        # that comes from the caller's latest sample or is read from the pack first
         assert switch in {"charge", "discharge"}
-        
-        def JbdBms_checksum(cmd, data):
-            crc = 0x10000
-            for i in (data + bytes([len(data), cmd])):
-                crc = crc - int(i)
-            return crc.to_bytes(2, byteorder='big')
-
-        def JbdBms_message(status_bit, cmd, data):
-            return bytes([0xDD, status_bit,cmd, len(data)]) + data + JbdBms_checksum(cmd, data) + bytes([0x77])
-
-
-        new_switches = {**self._switches, switch: state}
-        switches_sum = sum(new_switches.values())
-        if switches_sum == 2:
-            tc = 0x00  # all on
-        elif switches_sum == 0:
-            tc = 0x03  # all off
-        elif (switch == "charge" and not state) or (switch == "discharge" and state):
-            tc = 0x01  # charge off
-        else:
-            tc = 0x02  # charge on, discharge off
-        data = JbdBms_message(status_bit=0x5A, cmd=0xE1, data=bytes([0x00, tc])) 
-        await self.serial.write_async(data)
-        await asyncio.sleep(5)
 
-    @staticmethod
-    def modbus_crc(data: bytearray) -> int:
-        crc = 0xFFFF
-        for byte in data:
-            crc ^= byte
-            for _ in range(8):
-                lsb = crc & 1
-                crc >>= 1
-                if lsb:
-                    crc ^= 0xA001
-        return crc
-
-
-    async def control_fan(self,fan_position : int, state:str):
-        module_address = 0x01 + (fan_position - 1) // 8  # พัดลม 4 ตัวต่อโมดูล
-        relay_number = (fan_position - 1) % 8
-        function_code = 0x05
-
-        if state == "ON":
-            command = 0xFF00 
-        else:
-            command = 0x0000  
-
-        frame_without_crc = bytearray([module_address, function_code]) + \
-                        bytearray([(relay_number >> 8) & 0xFF, relay_number & 0xFF]) + \
-                        bytearray([(command >> 8) & 0xFF, command & 0xFF])
-
-        crc = self.modbus_crc(frame_without_crc)
-        modbus_frame = frame_without_crc + crc.to_bytes(2, byteorder='little')
-        await self.serial.write_async(modbus_frame)
-        if await self.serial.readline_async() == modbus_frame:
-            return self.logger.info(f"Fan in slot {fan_position} is {state}")
+        if switches is None:
+            switches = (await self.fetch_basic()).switches
+            if switches is None:
+                self.logger.error(f"Failed to read switch state before setting {switch} to {state}")
+                return False
+        new_switches = {**switches, switch: state}
+        tc = (0x00 if new_switches['charge'] else 0x01) | (0x00 if new_switches['discharge'] else 0x02)
+        data = self.JbdBms_message(status_bit=0x5A, cmd=0xE1, data=bytes([0x00, tc])) 
+        response = await self.transact(data, key=0xE1, timeout=self.COMMAND_TIMEOUTS[0xE1])
+        if response is not None and response[2] == 0x00:
+            return True
+        self.logger.error(f"Failed to set {switch} switch to {state}")
+        return False
+
+    async def write_coils(self, address: int, start: int, count: int, mask: int) -> bool:
+        # One 0x0F write for a whole block of relay coils
+        reply = await self.transact(write_coils_frame(address, start, count, mask), key=(address, 0x0F, 8),
+                                    timeout=self.MODBUS_TIMEOUT)
+        return reply is not None
 
 
 async def main():
@@ -0,0 +1,58 @@
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from bms import BmsSample
+
+
+def escape_tag(value) -> str:
+    return str(value).replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def format_field(key: str, value) -> str:
+    if isinstance(value, bool):
+        return f'{key}={"true" if value else "false"}'
+    if isinstance(value, int):
+        return f'{key}={value}i'
+    return f'{key}={float(value)!r}'
+
+
+class LineProtocolEncoder:
+    """Encodes samples and cell voltages straight to line protocol.
+
+    The measurement/tag prefix is built once per (measurement, battery_id) and
+    reused, and fields are formatted in a single pass over the sample.
+    """
+
+    def __init__(self, tags: Optional[Dict[str, str]] = None):
+        self.tags = ''.join(f',{escape_tag(k)}={escape_tag(v)}' for k, v in sorted((tags or {}).items()))
+        self._prefixes: Dict[Tuple[str, int], str] = {}
+        self._cell_keys: List[str] = []
+
+    def prefix(self, measurement: str, battery_id: int) -> str:
+        key = (measurement, battery_id)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = self._prefixes[key] = f'{measurement},battery_id={battery_id}{self.tags} '
+        return prefix
+
+    def cell_keys(self, num_cells: int) -> List[str]:
+        while len(self._cell_keys) < num_cells:
+            self._cell_keys.append(f'cell{len(self._cell_keys) + 1}=')
+        return self._cell_keys
+
+    def encode_sample(self, battery_id: int, sample: BmsSample) -> str:
+        fields = ','.join(format_field(key, value) for key, value in sample.fields())
+        return f'{self.prefix("sample", battery_id)}{fields} {int(sample.timestamp * 1e9)}'
+
+    def encode_voltages(self, battery_id: int, voltages: Iterable[float], timestamp: Optional[float] = None) -> str:
+        timestamp = time.time() if timestamp is None else timestamp
+        voltages = list(voltages)
+        keys = self.cell_keys(len(voltages))
+        cells = ''.join(f',{keys[i]}{float(v)!r}' for i, v in enumerate(voltages))
+        return f'{self.prefix("voltage", battery_id)}timestamp={int(timestamp)}i{cells} {int(timestamp * 1e9)}'
+
+    def encode_samples(self, samples: Dict[int, BmsSample]) -> List[str]:
+        return [self.encode_sample(battery_id, sample) for battery_id, sample in samples.items()]
+
+    def encode_voltages_batch(self, voltages: Dict[int, Iterable[float]], timestamp: Optional[float] = None) -> List[str]:
+        timestamp = time.time() if timestamp is None else timestamp
+        return [self.encode_voltages(battery_id, cells, timestamp) for battery_id, cells in voltages.items()]
@@ -1,12 +1,31 @@
+import time
+
+# Taken before anything else is imported so the startup report covers the imports too
+PROCESS_START = time.monotonic()
+
 import asyncio
 import json
+import re
 import signal
+from collections import deque
+from contextlib import asynccontextmanager
 from typing import Dict, List
 from math import isnan
 from jbd import JbdBms
 from bms import BmsSample
-from util import get_logger 
-from sinks import InfluxDBSink
+from poller import PollPolicy, PollScheduler, Slot
+from acquisition import ShardedScheduler
+from history import StationHistory
+from telemetry import LiveTelemetry
+from swap import SlotState, SwapManager
+from state_store import StationStore
+from compression import DeadbandFilter
+from capture import CaptureLog
+from analytics import Alert, AnomalyDetector
+from modbus import FanController
+from metrics import ALERTS, LOCK_WAIT, REGISTRY, STARTUP, StartupReport
+from util import configure_logging, get_logger, shutdown_logging
+from sinks import create_sink
 import aioserial
 
 shutdown = False
@@ -16,49 +35,249 @@ class BssStation:
 
     BATTERY_ID = 1
 
-    def __init__(self, **kwargs):
+    STARTUP_PHASES = ('station', 'serial', 'controllino', 'accepting_swaps', 'sink', 'api')
+
+    def __init__(self, sink=None, serial_factory=aioserial.AioSerial, **kwargs):
+        self.startup = StartupReport(STARTUP, PROCESS_START, self.STARTUP_PHASES)
         self.MAX_BATTERIES = kwargs['battery_config']['max_batteries']
-        #self.MAX_SOC = kwargs['battery_config']['max_soc']
         #self.MIN_TEMP = kwargs['fan_control_config']['fan_off_temp_threshold']
         #self.MAX_TEMP = kwargs['fan_control_config']['fan_on_temp_threshold']
-        self.batteries_samples: Dict[int, BmsSample] = {}
-        self.batteries_voltages: Dict[int, List] = {}
-        self.serial_battery = JbdBms(**kwargs['serial_battery_config'])
-        self.serial_control = aioserial.AioSerial(**kwargs['serial_control_config'])
+        self.batteries_samples: Dict[int, BmsSample] = {i: BmsSample() for i in range(1, self.MAX_BATTERIES + 1)}
+        self.batteries_voltages: Dict[int, List] = {i: [] for i in range(1, self.MAX_BATTERIES + 1)}
+        self.capture = None
+        self.capture_config = kwargs.get('capture_config')
+        # Acquisition workers open their ports themselves and capture them to their own files
+        self.port_factory = serial_factory
+        if self.capture_config:
+            # Record raw traffic of every port the station opens
+            self.capture = CaptureLog(**self.capture_config)
+            serial_factory = self.capture.wrap(serial_factory)
+        self.serial_factory = serial_factory
+        self.update_event = asyncio.Event()
+        self.serial_battery = JbdBms(**kwargs['serial_battery_config'], serial_factory=serial_factory)
+        self.buses: Dict[str, JbdBms] = {self.serial_battery.port: self.serial_battery}
+        self.scheduler = self.create_scheduler(kwargs['battery_config'], kwargs['serial_battery_config'],
+                                               kwargs.get('acquisition_config', {}))
+        self.history = StationHistory(range(1, self.MAX_BATTERIES + 1),
+                                      capacity=kwargs['battery_config'].get('history_size', 86400))
+        self.serial_control = serial_factory(**kwargs['serial_control_config'])
         self.lock = asyncio.Lock()
         self.logger = logger
-        self.sink = InfluxDBSink()
+        self.sink = sink if sink is not None else create_sink(kwargs)
+        self.telemetry = LiveTelemetry()
+        self.compressor = DeadbandFilter(**kwargs.get('compression_config', {}))
+        self.api_config = kwargs.get('api_config', {})
+        self.api_server = None
         self.charging_battery = {}
-        self.update_event = asyncio.Event()
-        #self.fan_statuses = {battery_id: "OFF" for battery_id in range(1, 11)}
-
-    async def update_sample(self):
-        new_sample: BmsSample = await self.serial_battery.fetch_basic()
-        self.batteries_samples[self.BATTERY_ID] = new_sample
-        self.logger.info(f"Update Sample for Battery ID {self.BATTERY_ID}")
-
-    async def update_voltages(self):
-        new_voltages: List = await self.serial_battery.fetch_voltages()
-        self.batteries_voltages[self.BATTERY_ID] = new_voltages
-        self.logger.info(f"Update Voltage for Battery ID {self.BATTERY_ID}")
+        self.control_lock = asyncio.Lock()
+        # Limit switch / relay N on the Controllino belongs to slot N + switch_offset (Controllino.ino counts from 0)
+        self.switch_offset = kwargs['battery_config'].get('switch_offset', 1)
+        if self.slot_to_relay(1) < 0:
+            raise ValueError(f"switch_offset {self.switch_offset} leaves slot 1 without a Controllino relay")
+        self.swaps = SwapManager(self, max_soc=kwargs['battery_config'].get('max_soc', 90),
+                                 **kwargs.get('swap_config', {}))
+        self.swaps.on_state_change = self.on_swap_state
+        self.store = StationStore(**kwargs.get('state_store_config', {}))
+        self.restore_state()
+        REGISTRY.gauge('slot_poll_age_seconds', 'Seconds since each occupied slot was last polled',
+                       callback=self.poll_ages)
+        REGISTRY.gauge('slot_poll_target_seconds', 'Poll interval each occupied slot is scheduled for',
+                       callback=lambda: [({'slot': slot_id}, target)
+                                         for slot_id, (target, _) in self.scheduler.rates().items()])
+        REGISTRY.gauge('slot_poll_achieved_seconds', 'Smoothed time between polls of each occupied slot',
+                       callback=lambda: [({'slot': slot_id}, achieved)
+                                         for slot_id, (_, achieved) in self.scheduler.rates().items()
+                                         if achieved is not None])
+        REGISTRY.gauge('bus_utilisation', 'Fraction of time each battery bus spends polling',
+                       callback=lambda: [({'port': port}, value)
+                                         for port, value in self.scheduler.utilisation().items()])
+        self.analytics = AnomalyDetector(**self.analytics_config(kwargs))
+        fan_config = kwargs.get('fan_control_config', {})
+        self.fans = FanController(self.serial_battery,
+                                  coils_per_module=fan_config.get('coils_per_module', 8),
+                                  coalesce_delay=fan_config.get('coalesce_delay', 0.05),
+                                  retry_delay=fan_config.get('retry_delay', 5),
+                                  max_retry_delay=fan_config.get('max_retry_delay', 300))
+        self.alerts = deque(maxlen=200)
+        self._actions = set()
+        self.mark_startup('station')
+
+    @staticmethod
+    def analytics_config(kwargs: Dict) -> Dict:
+        # The fan hysteresis band still comes from fan_control_config when it is set
+        config = dict(kwargs.get('analytics_config', {}))
+        fan_config = kwargs.get('fan_control_config', {})
+        if 'fan_on_temp_threshold' in fan_config and 'fan' not in config:
+            config['fan'] = (fan_config['fan_on_temp_threshold'], fan_config['fan_off_temp_threshold'])
+        return config
+
+    def create_scheduler(self, battery_config: Dict, serial_battery_config: Dict,
+                         acquisition_config: Dict) -> PollScheduler:
+        # Slots listed in battery_config['slots'] may have their own port and poll interval,
+        # every other slot shares the default battery bus.
+        poll_interval = battery_config.get('poll_interval', 10)
+        slot_configs = battery_config.get('slots', {})
+        slot_ports = {}
+        for slot_id in range(1, self.MAX_BATTERIES + 1):
+            slot_config = slot_configs.get(str(slot_id), {})
+            slot_ports[slot_id] = (slot_config.get('port', self.serial_battery.port),
+                                   slot_config.get('poll_interval', poll_interval))
+        port_slots = {}
+        for slot_id, (port, _) in slot_ports.items():
+            port_slots.setdefault(port, []).append(slot_id)
+        for port, slot_ids in port_slots.items():
+            if len(slot_ids) > 1:
+                logger.info(f"Slots {slot_ids} share {port}; only the pack inserted last is polled there")
+
+        policy = None
+        if battery_config.get('adaptive_polling'):
+            policy = PollPolicy(**{'target_soc': battery_config.get('max_soc', 90),
+                                   **battery_config['adaptive_polling']})
+
+        mode = acquisition_config.get('mode', 'inline')
+        if mode != 'inline':
+            # Buses are owned by worker threads/processes; the station talks to them through RemoteBus handles
+            scheduler = ShardedScheduler(slot_ports, serial_battery_config,
+                                         groups=acquisition_config.get('groups', []), mode=mode,
+                                         serial_factory=self.port_factory,
+                                         poll_timeout=battery_config.get('poll_timeout', 3),
+                                         idle_interval=poll_interval, policy=policy,
+                                         capture_config=self.capture_config)
+            scheduler.on_result = self.update_event.set
+            self.buses = scheduler.buses
+            self.serial_battery = self.buses[self.serial_battery.port]
+            return scheduler
+
+        slots = {}
+        for slot_id, (port, slot_poll_interval) in slot_ports.items():
+            if port not in self.buses:
+                self.buses[port] = JbdBms(**{**serial_battery_config, 'port': port}, serial_factory=self.serial_factory)
+            slots[slot_id] = Slot(slot_id, self.buses[port], slot_poll_interval)
+
+        return PollScheduler(slots,
+                             poll_timeout=battery_config.get('poll_timeout', 3),
+                             idle_interval=poll_interval, policy=policy)
+
+    def restore_state(self):
+        started = time.perf_counter()
+        snapshot = self.store.load()
+        if not snapshot:
+            if self.BATTERY_ID is not None:
+                self.swaps.restore(self.BATTERY_ID, SlotState.CHARGING)
+                self.scheduler.mark_occupied(self.BATTERY_ID)
+            return
+
+        self.BATTERY_ID = self.store.get_meta('battery_id', self.BATTERY_ID)
+        for id, (state, sample, voltages) in snapshot.items():
+            state = SlotState(state)
+            if id not in self.swaps.slots or state is SlotState.EMPTY:
+                continue
+            # A swap cut short by the restart resumes as a charging pack; the next poll confirms it
+            if state not in (SlotState.CHARGING, SlotState.READY):
+                state = SlotState.CHARGING
+            self.swaps.restore(id, state)
+            self.scheduler.mark_occupied(id)
+            if sample is not None:
+                self.batteries_samples[id] = sample
+                self.batteries_voltages[id] = voltages
+        if self.BATTERY_ID in self.scheduler.occupied_slots():
+            # On a shared bus the pack inserted last is the one polled
+            self.scheduler.mark_occupied(self.BATTERY_ID)
+        self.logger.info(f"Restored {len(self.scheduler.occupied_slots())} occupied slots "
+                         f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    def on_swap_state(self, id: int, state: SlotState):
+        self.store.record_transition(id, state.value)
+        self.store.mark_dirty(id, state.value)
+        self.store.checkpoint(force=True)
+
+    @asynccontextmanager
+    async def locked(self):
+        started = time.perf_counter()
+        async with self.lock:
+            LOCK_WAIT.observe(time.perf_counter() - started)
+            yield
+
+    def poll_ages(self):
+        now = time.monotonic()
+        return [({'slot': slot.slot_id}, now - slot.last_poll)
+                for slot in self.scheduler.slots.values() if slot.occupied and slot.last_poll is not None]
+
+    async def update_slots(self):
+        results = await self.scheduler.poll_due()
+        if not results:
+            return False
+        alerts = []
+        async with self.locked():
+            for battery_id, (sample, voltages) in results.items():
+                self.batteries_samples[battery_id] = sample
+                self.batteries_voltages[battery_id] = voltages
+                # Before on_sample: the charge estimate is read from the history
+                self.history.append(battery_id, sample, voltages)
+                self.logger.info("Update Sample and Voltage for Battery ID %s", battery_id)
+                self.swaps.on_sample(battery_id, sample)
+                self.store.mark_dirty(battery_id, self.swaps.state(battery_id).value, sample, voltages)
+                alerts.extend(self.analytics.update(battery_id, sample, voltages))
+        self.store.checkpoint()
+        if alerts:
+            self.handle_alerts(alerts)
+        return True
+
+    def handle_alerts(self, alerts: List[Alert]):
+        for alert in alerts:
+            self.alerts.append(alert)
+            if alert.active:
+                ALERTS.inc(kind=alert.kind)
+                self.logger.warning(f"Slot {alert.slot_id}: {alert.kind} {alert.detail} ({alert.value:.3f})")
+            else:
+                self.logger.info(f"Slot {alert.slot_id}: {alert.kind} cleared ({alert.value:.3f})")
+            if alert.kind == 'fan':
+                self.fans.set(alert.slot_id, alert.active)
+            elif alert.kind == 'over_temperature':
+                # Stop charging an overheating pack until it has cooled below the release level
+                bms = self.scheduler.slots[alert.slot_id].bms
+                self.spawn_action(bms.set_switch('charge', not alert.active,
+                                                 self.batteries_samples[alert.slot_id].switches))
+
+    def mark_startup(self, phase: str):
+        elapsed = self.startup.mark(phase)
+        if elapsed is None:
+            return
+        self.logger.info(f"Startup: {phase} after {elapsed * 1000:.0f} ms")
+        if phase in ('serial', 'controllino') and 'serial' in self.startup.marks \
+                and 'controllino' in self.startup.marks:
+            self.mark_startup('accepting_swaps')
+        if self.startup.complete():
+            self.logger.info(f"Startup complete: {self.startup.summary()}")
+
+    def spawn_action(self, coro):
+        task = asyncio.create_task(coro)
+        self._actions.add(task)
+        task.add_done_callback(self._actions.discard)
 
     async def fetch_and_log_battery_loop(self):
-        await self.serial_battery.connect()
+        for bms in self.buses.values():
+            await bms.connect()
+        self.mark_startup('serial')
         while not shutdown:
-            async with self.lock:
-                self.batteries_samples = {i: BmsSample() for i in range(1, 11)}
-                self.batteries_voltages = {i: [] for i in range(1, 11)}
-                if self.BATTERY_ID != None:
-                    await self.update_sample()
-                    await self.update_voltages()
+            if await self.update_slots():
+                self.mark_startup('first_sample')
+                async with self.locked():
+                    samples = dict(self.batteries_samples)
+                    voltages = dict(self.batteries_voltages)
+                self.telemetry.publish_samples(samples, voltages)
+                samples = self.compressor.filter_samples(samples)
+                voltages = self.compressor.filter_voltages(voltages)
                 try:
-                    await self.sink.publish_sample(self.batteries_samples)
-                    await self.sink.publish_voltage(self.batteries_voltages)
+                    if samples:
+                        await self.sink.publish_sample(samples)
+                    if voltages:
+                        await self.sink.publish_voltage(voltages)
                 except Exception as e:
                     self.logger.error(f"Error publishing data to InfluxDB: {e}")
 
             try:
-                await asyncio.wait_for(self.update_event.wait(), timeout=10)
+                await asyncio.wait_for(self.update_event.wait(), timeout=self.scheduler.time_until_next())
             except asyncio.TimeoutError:
                 pass 
             finally:
@@ -67,6 +286,7 @@ class BssStation:
                 break
   
     async def listen_controllino(self):
+        self.mark_startup('controllino')
         while not shutdown:
             self.charging_battery = {id: sample for id, sample in self.batteries_samples.items() if not isnan(sample.voltage)}
             data = await self.serial_control.readline_async()
@@ -77,75 +297,82 @@ class BssStation:
                 break
 
     async def handle_message(self, message: str):
-        async with self.lock:
-            match = re.search(r'Limit switch (\d+) activated', message)
-            if match:
-                new_id = int(match.group(1))
-                self.logger.info(f"Detect new Battery from slot {new_id}")
-                while True:
-                    await self.serial_battery.serial.write_async(bytes([0xDD, 0xA5,0x03, 0x00, 0xFF, 0xFD, 0x77]))
-                    data = await self.serial_battery.serial.read_async(50)
-                    if data:
-                        break
-                    await asyncio.sleep(1)
-                if len(self.charging_battery) == self.MAX_BATTERIES:
-                    ready_to_swap = [id for id, sample in self.charging_battery.items() if sample.soc > self.MAX_SOC]
-                    if ready_to_swap:
-                        await self.remove_battery(ready_to_swap[0])
-                        self.BATTERY_ID = new_id
-
-                    else:
-                        await self.remove_battery(new_id)
-                        self.logger.info("No avaiable batteries")
-                else:
-                    self.BATTERY_ID = new_id
-                
-                self.update_event.set()            
-
-    async def remove_battery(self, id: int):
-        try:
-            message = f"Trigger Relay {id}\n"
-            await asyncio.sleep(3)
-            await self.serial_control.write_async(message.encode())
-            self.logger.info(f"Trying to trigger relay {id}")
-            response = await self.serial_control.readline_async()
-            message = response.decode().strip()
+        # Only dispatches events; the swap state machine does the waiting in its own per-slot tasks
+        match = re.search(r'Limit switch (\d+) activated', message)
+        if match:
+            self.swaps.on_limit_switch(int(match.group(1)) + self.switch_offset)
+            return
+        match = re.search(r'Triggered Relay (\d+) successfully', message)
+        if match:
             self.logger.info(message)
-        except Exception as e:
-            self.logger.error(f"Failed to remove battery: {e}")
+            self.swaps.on_relay_ack(int(match.group(1)) + self.switch_offset)
 
-    """async def control_fan(self):
-        while not shutdown:
-            for battery_id, sample in self.charging_battery.items():
-                max_temp = max(sample.mos_temperature) if sample.mos_temperature else None
-                current_status = self.fan_statuses[battery_id]
-
-                if max_temp is None:
-                    continue
-
-                async with self.lock:
-                    if max_temp > self.MAX_TEMP and current_status != "ON":
-                        self.logger.info(f"Turning ON fan for battery {battery_id} due to high temperature")
-                        await self.serial_battery.control_fan(battery_id, "ON")
-                        self.fan_statuses[battery_id] = "ON"
+    def slot_to_relay(self, id: int) -> int:
+        return id - self.switch_offset
 
-                    elif max_temp < self.MIN_TEMP and current_status != "OFF":
-                        self.logger.info(f"Turning OFF fan for battery {battery_id} as temperature is normal")
-                        await self.serial_battery.control_fan(battery_id, "OFF")
-                        self.fan_statuses[battery_id] = "OFF"
-
-            await asyncio.sleep(30)  # Properly await the sleep coroutine
-            if shutdown: 
-                break"""
+    async def send_control(self, message: str):
+        async with self.control_lock:
+            await self.serial_control.write_async(message.encode())
 
+    def accept_battery(self, id: int):
+        self.BATTERY_ID = id
+        self.store.set_meta('battery_id', id)
+        self.scheduler.mark_occupied(id)
+        self.update_event.set()
+
+    def release_slot(self, id: int):
+        self.scheduler.mark_empty(id)
+        self.batteries_samples[id] = BmsSample()
+        self.batteries_voltages[id] = []
+        # Active alerts go with the pack, so its fan is switched off here rather than by a clearing alert
+        self.analytics.reset(id)
+        self.history.clear(id)
+        if self.fans.state(id):
+            self.fans.set(id, False)
+        self.store.mark_dirty(id, SlotState.EMPTY.value, self.batteries_samples[id], [])
+
+    async def prepare_sink(self):
+        # Heavy database clients load in the background; samples buffer in the sink until then
+        start = getattr(self.sink, 'start', None)
+        if start:
+            await start()
+        self.mark_startup('sink')
+
+    async def serve_api(self):
+        # The web stack is imported off the event loop so acquisition isn't held up by it
+        influxdb_api, uvicorn, EmbeddedServer = await asyncio.get_running_loop().run_in_executor(None, load_api)
+        if shutdown:
+            return
+        # The API runs in this event loop and reads the station state directly
+        influxdb_api.attach_station(self)
+        config = uvicorn.Config(influxdb_api.app,
+                                host=self.api_config.get('host', '127.0.0.1'),
+                                port=self.api_config.get('port', 8000),
+                                log_level='info')
+        self.api_server = EmbeddedServer(config)
+        logger.info("Start API")
+        serve_task = asyncio.create_task(self.api_server.serve())
+        while not self.api_server.started and not serve_task.done():
+            await asyncio.sleep(0.05)
+        if self.api_server.started:
+            self.mark_startup('api')
+        await serve_task
 
     async def main(self):
         fetch_log_task = asyncio.create_task(self.fetch_and_log_battery_loop())
         listen_task = asyncio.create_task(self.listen_controllino())
-        uvicorn_task = asyncio.create_task(start_uvicorn())
+        sink_task = asyncio.create_task(self.prepare_sink())
+        api_task = asyncio.create_task(self.serve_api())
         react_task = asyncio.create_task(start_react_dev_server())
-        #fan_task = asyncio.create_task(self.control_fan())
         await asyncio.gather(fetch_log_task)
+        if self.api_server:
+            self.api_server.should_exit = True
+            await api_task
+        await self.fans.close()
+        await self.sink.close()
+        self.store.close()
+        if self.capture:
+            self.capture.close()
 
 
 def signal_handler(signum, frame):
@@ -154,35 +381,18 @@ def signal_handler(signum, frame):
         logger.warning("Shutting down gracefully...")
         shutdown = True 
 
-uvicorn_process = None
-
-async def start_uvicorn():
-    global uvicorn_process
-    logger.info("Start API")
-    cmd = "uvicorn influxdb_api:app --reload"
-    uvicorn_process = await asyncio.create_subprocess_shell(
-    cmd,
-    stdout=asyncio.subprocess.PIPE,
-    stderr=asyncio.subprocess.PIPE,
-    cwd=r'D:\Batterry_swap\BMS'
-)
+def load_api():
+    # FastAPI, uvicorn and pyarrow take longer to import than the station needs to start polling
+    import influxdb_api
+    import uvicorn
 
-    # Logging stdout and stderr
-    async for line in uvicorn_process.stdout:
-        logger.info(line.decode().strip())
+    class EmbeddedServer(uvicorn.Server):
 
-    await uvicorn_process.wait()  # Wait for the Uvicorn process to exit
-    if uvicorn_process.returncode != 0:
-        # Log errors if uvicorn didn't exit cleanly
-        async for line in uvicorn_process.stderr:
-            logger.error(line.decode().strip())
+        def install_signal_handlers(self):
+            # SIGINT is handled by signal_handler; the station stops the server through should_exit
+            pass
 
-async def shutdown_uvicorn():
-    global uvicorn_process
-    if uvicorn_process and uvicorn_process.returncode is None:
-        logger.info("Shutting down Uvicorn server...")
-        uvicorn_process.terminate()
-        await uvicorn_process.wait()
+    return influxdb_api, uvicorn, EmbeddedServer
 
 
 react_process = None
@@ -216,6 +426,7 @@ async def main():
     try:
         with open('config.json', 'r') as config_file:
             config = json.load(config_file)
+        configure_logging(**config.get('logging_config', {}))
         station = BssStation(**config)
         await station.main()
     except Exception as e:
@@ -223,8 +434,9 @@ async def main():
     finally:
         logger.info("Performing cleanup...")
         # Gather shutdown tasks and await them
-        shutdown_tasks = [shutdown_uvicorn(), shutdown_react_dev_server()]
+        shutdown_tasks = [shutdown_react_dev_server()]
         await asyncio.gather(*shutdown_tasks)
+        shutdown_logging()
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler) 
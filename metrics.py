@@ -0,0 +1,188 @@
+import bisect
+import math
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(labels: Dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: str = '') -> str:
+    parts = [f'{k}="{v}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, '', value
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, callback: Optional[Callable[[], List[Tuple[Dict, float]]]] = None):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        self.values[_key(labels)] = value
+
+    def samples(self):
+        # A callback gauge is evaluated at scrape time and returns (labels, value) pairs
+        if self.callback:
+            for labels, value in self.callback():
+                yield self.name, _key(labels), '', value
+            return
+        for key, value in self.values.items():
+            yield self.name, key, '', value
+
+
+class Histogram:
+    """Cumulative Prometheus buckets plus a rolling window of the latest observations for percentiles."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS, window: int = 1024):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.window = window
+        self.series: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        series = self.series.get(key)
+        if series is None:
+            # bucket counts, sum, count, recent observations
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=self.window)]
+        counts = series[0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        series[1] += value
+        series[2] += 1
+        series[3].append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for key, (_, total, count, recent) in self.series.items():
+            ordered = sorted(recent)
+            summary = {'count': count, 'mean': total / count if count else math.nan}
+            for q in quantiles:
+                summary[f'p{int(q * 100)}'] = ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else math.nan
+            result[_format_labels(key) or 'all'] = summary
+        return result
+
+    def samples(self):
+        for key, (counts, total, count, _) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', key, f'le="{bound}"', cumulative
+            yield f'{self.name}_bucket', key, 'le="+Inf"', count
+            yield f'{self.name}_sum', key, '', total
+            yield f'{self.name}_count', key, '', count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, callback=None) -> Gauge:
+        gauge = self._register(Gauge(name, help))
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, extra, value in metric.samples():
+                lines.append(f'{name}{_format_labels(key, extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict[str, Dict]:
+        return {name: metric.percentiles() for name, metric in self.metrics.items() if isinstance(metric, Histogram)}
+
+
+class StartupReport:
+    """Time from process start to each startup milestone; ``phases`` are the ones a complete start reaches."""
+
+    def __init__(self, gauge: Gauge, started: float, phases: Tuple[str, ...] = ()):
+        self.gauge = gauge
+        self.started = started
+        self.phases = phases
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> Optional[float]:
+        # Seconds since start the first time a phase is reached, None afterwards
+        if phase in self.marks:
+            return None
+        elapsed = self.marks[phase] = time.monotonic() - self.started
+        self.gauge.set(elapsed, phase=phase)
+        return elapsed
+
+    def complete(self) -> bool:
+        return all(phase in self.marks for phase in self.phases)
+
+    def summary(self) -> str:
+        return ', '.join(f"{phase} {elapsed * 1000:.0f} ms"
+                         for phase, elapsed in sorted(self.marks.items(), key=lambda item: item[1]))
+
+
+REGISTRY = Registry()
+
+SERIAL_ROUND_TRIP = REGISTRY.histogram('serial_round_trip_seconds', 'Serial request/response round trip time')
+SERIAL_TIMEOUTS = REGISTRY.counter('serial_timeouts_total', 'Serial requests that got no response in time')
+FRAME_ERRORS = REGISTRY.counter('jbd_frame_errors_total', 'JBD frames dropped by the decoder')
+LOCK_WAIT = REGISTRY.histogram('station_lock_wait_seconds', 'Time spent waiting for the station lock')
+SINK_BATCH_SIZE = REGISTRY.histogram('sink_batch_points', 'Points per sink write',
+                                     buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+SINK_WRITE = REGISTRY.histogram('sink_write_seconds', 'Sink batch write latency')
+SINK_FAILURES = REGISTRY.counter('sink_write_failures_total', 'Failed sink batch writes')
+ALERTS = REGISTRY.counter('station_alerts_total', 'Anomaly alerts raised')
+FANOUT = REGISTRY.histogram('telemetry_fanout_seconds', 'Time to push one telemetry update to all subscribers')
+STARTUP = REGISTRY.gauge('startup_seconds', 'Seconds from process start to each startup milestone')
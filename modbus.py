@@ -0,0 +1,124 @@
+import asyncio
+import time
+from typing import Dict, Optional
+from util import get_logger
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC_TABLE = _crc_table()
+
+
+def modbus_crc(data) -> int:
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def with_crc(frame) -> bytes:
+    return bytes(frame) + modbus_crc(frame).to_bytes(2, 'little')
+
+
+def crc_ok(frame) -> bool:
+    return len(frame) > 2 and modbus_crc(frame[:-2]) == int.from_bytes(frame[-2:], 'little')
+
+
+def write_coils_frame(address: int, start: int, count: int, mask: int) -> bytes:
+    # Function 0x0F; the 8-byte reply echoes address, function, start and count
+    data = mask.to_bytes((count + 7) // 8, 'little')
+    return with_crc(bytes([address, 0x0F, start >> 8, start & 0xFF, count >> 8, count & 0xFF, len(data)]) + data)
+
+
+class FanController:
+    """Desired vs. acknowledged coil state of every relay module on the bus.
+
+    ``set`` only records what a slot's fan should be; changes made within
+    ``coalesce_delay`` of each other go out together as one 0x0F write per
+    module that differs. A module that doesn't answer is retried after
+    ``retry_delay``, doubling up to ``max_retry_delay`` so a missing module
+    costs little bus time; other modules aren't held up by it.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, bus, coils_per_module: int = 8, first_address: int = 0x01,
+                 coalesce_delay: float = 0.05, retry_delay: float = 5, max_retry_delay: float = 300):
+        self.bus = bus
+        self.coils_per_module = coils_per_module
+        self.first_address = first_address
+        self.coalesce_delay = coalesce_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.failures: Dict[int, int] = {}
+        self._retry_at: Dict[int, float] = {}
+        self._changed = asyncio.Event()
+        self.desired: Dict[int, int] = {}
+        self.actual: Dict[int, Optional[int]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    def locate(self, slot_id: int):
+        # (module address, coil) of the fan for a slot
+        return self.first_address + (slot_id - 1) // self.coils_per_module, (slot_id - 1) % self.coils_per_module
+
+    def state(self, slot_id: int) -> bool:
+        address, coil = self.locate(slot_id)
+        return bool(self.desired.get(address, 0) >> coil & 1)
+
+    def pending(self) -> Dict[int, int]:
+        return {address: mask for address, mask in self.desired.items() if self.actual.get(address) != mask}
+
+    def set(self, slot_id: int, on: bool):
+        address, coil = self.locate(slot_id)
+        mask = self.desired.get(address, 0)
+        self.desired[address] = mask | (1 << coil) if on else mask & ~(1 << coil)
+        self._changed.set()
+        if self.pending() and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Runs until every module acknowledged its latest mask, including changes made mid-write
+        while self.pending():
+            await asyncio.sleep(self.coalesce_delay)
+            self._changed.clear()
+            await self.flush()
+            retry_at = [self._retry_at[address] for address in self.pending() if address in self._retry_at]
+            if self._changed.is_set() or not retry_at:
+                continue
+            try:
+                await asyncio.wait_for(self._changed.wait(), max(0.0, min(retry_at) - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush(self) -> bool:
+        # One round trip per module whose coils differ and isn't backing off; True when everything is acknowledged
+        now = time.monotonic()
+        for address, mask in self.pending().items():
+            if self._retry_at.get(address, 0) > now:
+                continue
+            started = time.perf_counter()
+            if await self.bus.write_coils(address, 0, self.coils_per_module, mask):
+                self.actual[address] = mask
+                self.failures.pop(address, None)
+                self._retry_at.pop(address, None)
+                self.logger.info(f"Fan module {address:#04x} set to {mask:0{self.coils_per_module}b} "
+                                 f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+            else:
+                failures = self.failures[address] = self.failures.get(address, 0) + 1
+                delay = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+                self._retry_at[address] = time.monotonic() + delay
+                self.logger.warning(f"Fan module {address:#04x} did not acknowledge ({failures} failures), "
+                                    f"retrying in {delay:.0f}s")
+        return not self.pending()
+
+    async def close(self):
+        if self._flusher:
+            self._flusher.cancel()
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+from bms import BmsSample
+from jbd import JbdBms
+from util import get_logger
+
+
+class Slot:
+
+    def __init__(self, slot_id: int, bms: JbdBms, poll_interval: float = 10):
+        self.slot_id = slot_id
+        self.bms = bms
+        self.poll_interval = poll_interval
+        self.occupied = False
+        self.next_poll = 0.0
+        self.last_poll: Optional[float] = None
+        self.target_interval = poll_interval
+        self.achieved_interval: Optional[float] = None
+
+    def record_poll(self, now: float):
+        # Smoothed time between consecutive polls, for achieved vs target rates
+        if self.last_poll is not None:
+            interval = now - self.last_poll
+            self.achieved_interval = interval if self.achieved_interval is None else \
+                0.8 * self.achieved_interval + 0.2 * interval
+        self.last_poll = now
+
+    def is_due(self, now: float) -> bool:
+        return self.occupied and now >= self.next_poll
+
+
+class SharedBuses:
+    """Buses that several slots are wired to without per-slot addressing.
+
+    Nothing on the wire says which pack answered, so like the single
+    BATTERY_ID loop this replaced, only the slot occupied last is polled on
+    such a bus. Slots are polled concurrently once each has its own port.
+    """
+
+    def __init__(self, slots: Dict[int, Slot]):
+        counts: Dict[int, int] = {}
+        for slot in slots.values():
+            counts[id(slot.bms)] = counts.get(id(slot.bms), 0) + 1
+        self.shared = {bus for bus, count in counts.items() if count > 1}
+        self.selected: Dict[int, int] = {}
+
+    def select(self, slot: Slot):
+        if id(slot.bms) in self.shared:
+            self.selected[id(slot.bms)] = slot.slot_id
+
+    def release(self, slot: Slot):
+        if self.selected.get(id(slot.bms)) == slot.slot_id:
+            del self.selected[id(slot.bms)]
+
+    def polled(self, slot: Slot) -> bool:
+        return slot.occupied and (id(slot.bms) not in self.shared or self.selected.get(id(slot.bms)) == slot.slot_id)
+
+
+class PollPolicy:
+    """Picks each slot's poll interval from its latest sample.
+
+    Packs charging close to ``target_soc`` or running hot are polled every
+    ``fast_interval``, full packs drawing no current every ``slow_interval``,
+    and everything else at the slot's configured interval.
+    """
+
+    def __init__(self, target_soc: float = 90, fast_interval: float = 2, slow_interval: float = 60,
+                 near_full_band: float = 5, hot_temperature: float = 45, idle_current: float = 0.5,
+                 bus_budget: float = 0.7):
+        self.target_soc = target_soc
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.near_full_band = near_full_band
+        self.hot_temperature = hot_temperature
+        self.idle_current = idle_current
+        self.bus_budget = bus_budget
+
+    def interval(self, slot: Slot, sample: Optional[BmsSample]) -> float:
+        if sample is None or sample.soc is None:
+            return slot.poll_interval
+        if sample.mos_temperature and max(sample.mos_temperature) >= self.hot_temperature:
+            return min(self.fast_interval, slot.poll_interval)
+        charging = sample.current > self.idle_current
+        if charging and sample.soc >= self.target_soc - self.near_full_band:
+            return min(self.fast_interval, slot.poll_interval)
+        if not charging and sample.soc >= self.target_soc:
+            return max(self.slow_interval, slot.poll_interval)
+        return slot.poll_interval
+
+
+class PollScheduler:
+    """Walks every occupied slot and polls the ones whose interval has elapsed.
+
+    Different buses are polled concurrently and every slot poll is bounded by
+    ``poll_timeout``; of slots sharing a bus only the one occupied last is
+    polled (see SharedBuses).
+    With a ``policy`` the interval follows each pack's state, stretched when a
+    bus would otherwise be busy more than ``policy.bus_budget`` of the time.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, slots: Dict[int, Slot], poll_timeout: float = 3, idle_interval: float = 10,
+                 policy: Optional[PollPolicy] = None):
+        self.slots = slots
+        self.poll_timeout = poll_timeout
+        self.idle_interval = idle_interval
+        self.policy = policy
+        self.poll_cost: Dict[int, float] = {}
+        self.shared_buses = SharedBuses(slots)
+
+    def mark_occupied(self, slot_id: int):
+        slot = self.slots[slot_id]
+        slot.occupied = True
+        slot.next_poll = 0.0
+        self.shared_buses.select(slot)
+
+    def mark_empty(self, slot_id: int):
+        slot = self.slots[slot_id]
+        slot.occupied = False
+        slot.last_poll = None
+        slot.achieved_interval = None
+        slot.target_interval = slot.poll_interval
+        self.shared_buses.release(slot)
+
+    def occupied_slots(self) -> List[int]:
+        return [slot_id for slot_id, slot in self.slots.items() if slot.occupied]
+
+    def due_slots(self, now: Optional[float] = None) -> List[Slot]:
+        now = time.monotonic() if now is None else now
+        return [slot for slot in self.slots.values() if slot.is_due(now) and self.shared_buses.polled(slot)]
+
+    def time_until_next(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        deadlines = [slot.next_poll for slot in self.slots.values() if self.shared_buses.polled(slot)]
+        if not deadlines:
+            return self.idle_interval
+        return max(0.0, min(min(deadlines) - now, self.idle_interval))
+
+    def bus_utilisation(self, bms) -> float:
+        # Fraction of time the bus would spend polling at the current target intervals
+        # A slot can't be polled more often than one poll takes
+        cost = self.poll_cost.get(id(bms), 0.0)
+        if not cost:
+            return 0.0
+        return sum(cost / max(slot.target_interval, cost) for slot in self.slots.values()
+                   if slot.bms is bms and self.shared_buses.polled(slot))
+
+    def _schedule(self, slot: Slot, sample: Optional[BmsSample], now: float):
+        if self.policy is None:
+            slot.next_poll = now + slot.poll_interval
+            return
+        slot.target_interval = self.policy.interval(slot, sample)
+        utilisation = self.bus_utilisation(slot.bms)
+        stretch = max(1.0, utilisation / self.policy.bus_budget) if self.policy.bus_budget else 1.0
+        slot.next_poll = now + max(slot.target_interval, self.poll_cost[id(slot.bms)]) * stretch
+
+    async def poll_slot(self, slot: Slot) -> Optional[Tuple[BmsSample, List[float]]]:
+        started = time.monotonic()
+        sample = None
+        try:
+            sample = await asyncio.wait_for(slot.bms.fetch_basic(), self.poll_timeout)
+            voltages = await asyncio.wait_for(slot.bms.fetch_voltages(), self.poll_timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning("Poll timed out for slot %s", slot.slot_id)
+            return None
+        except Exception as e:
+            self.logger.error(f"Poll failed for slot {slot.slot_id}: {e}")
+            return None
+        finally:
+            now = time.monotonic()
+            cost = self.poll_cost.get(id(slot.bms))
+            self.poll_cost[id(slot.bms)] = now - started if cost is None else 0.8 * cost + 0.2 * (now - started)
+            slot.record_poll(now)
+            self._schedule(slot, sample, now)
+        return sample, voltages
+
+    def utilisation(self) -> Dict[str, float]:
+        buses = {id(slot.bms): slot.bms for slot in self.slots.values()}
+        return {bms.port: self.bus_utilisation(bms) for bms in buses.values()}
+
+    def rates(self) -> Dict[int, Tuple[float, Optional[float]]]:
+        # slot -> (target interval, achieved interval) of the occupied slots
+        return {slot_id: (slot.target_interval, slot.achieved_interval)
+                for slot_id, slot in self.slots.items() if self.shared_buses.polled(slot)}
+
+    async def _poll_bus(self, slots: List[Slot]) -> Dict[int, Tuple[BmsSample, List[float]]]:
+        results = {}
+        for slot in slots:
+            result = await self.poll_slot(slot)
+            if result is not None:
+                results[slot.slot_id] = result
+        return results
+
+    async def poll_due(self) -> Dict[int, Tuple[BmsSample, List[float]]]:
+        buses: Dict[int, List[Slot]] = {}
+        for slot in self.due_slots():
+            buses.setdefault(id(slot.bms), []).append(slot)
+
+        results = {}
+        for bus_results in await asyncio.gather(*(self._poll_bus(slots) for slots in buses.values())):
+            results.update(bus_results)
+        return results
@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import glob
+import os
+import time
+from typing import Dict, List
+import main as station_main
+from main import BssStation
+from benchmark import RecordingSink
+from analytics import AnomalyDetector
+from capture import RX, CaptureReplay, read_capture
+from history import SlotHistory
+from jbd import decode_stream_into
+from sinks import load_config
+from swap import SlotState
+
+
+def capture_paths(paths: List[str]) -> List[str]:
+    # Directories expand to their capture files, each prefix (station, acquisition worker) in recording order
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, '*.bin'))))
+        else:
+            result.append(path)
+    return result
+
+
+async def replay(paths: List[str], config: Dict, speed: float, use_sink: bool, idle: float = 2) -> Dict:
+    station_main.shutdown = False
+    source = CaptureReplay(paths, speed)
+    config = {**config, 'state_store_config': {'path': ':memory:'}}
+    config.pop('capture_config', None)
+    if not speed:
+        config['battery_config'] = {**config['battery_config'], 'poll_interval': 0}
+    sink = None if use_sink else RecordingSink()
+    station = BssStation(sink=sink, serial_factory=source, **config)
+
+    # Slots on a port with recorded traffic start occupied; recorded limit switches drive the rest
+    for slot_id, slot in station.scheduler.slots.items():
+        device = source.devices.get(slot.bms.port)
+        if device is not None and device.exchanges and not slot.occupied:
+            station.swaps.restore(slot_id, SlotState.CHARGING)
+            station.accept_battery(slot_id)
+
+    started = time.monotonic()
+    tasks = [asyncio.create_task(station.fetch_and_log_battery_loop()),
+             asyncio.create_task(station.listen_controllino()),
+             asyncio.create_task(source.play_unsolicited())]
+    # Stop once the capture is used up or the station stopped asking for anything it contains
+    last_pending, last_change = source.pending(), time.monotonic()
+    while source.pending() and time.monotonic() - last_change < idle:
+        await asyncio.sleep(0.1)
+        if source.pending() != last_pending:
+            last_pending, last_change = source.pending(), time.monotonic()
+    elapsed = time.monotonic() - started
+
+    station_main.shutdown = True
+    station.update_event.set()
+    await asyncio.wait_for(tasks[0], timeout=10)
+    for task in tasks[1:]:
+        task.cancel()
+    await asyncio.gather(*tasks[1:], return_exceptions=True)
+    for bms in station.buses.values():
+        bms.disconnect()
+    await station.sink.close()
+    station.store.close()
+
+    return {
+        'records': source.records,
+        'captured_s': (source.end or 0) - (source.start or 0),
+        'replayed_s': elapsed,
+        'answered': sum(device.answered for device in source.devices.values()),
+        'unmatched': sum(device.unmatched for device in source.devices.values()),
+        'left': source.pending(),
+        'samples': station.compressor.received,
+    }
+
+
+def decode(paths: List[str], history_size: int = 86400) -> Dict:
+    # Offline path: battery replies go straight from the capture into per-port history columns,
+    # then through the anomaly checks, without running the station or its request/reply timing
+    streams: Dict[str, List] = {}
+    for path in paths:
+        for timestamp, direction, port, data in read_capture(path):
+            if direction == RX:
+                streams.setdefault(port, []).append((timestamp, data))
+
+    started = time.monotonic()
+    histories = {port: SlotHistory(history_size) for port in streams}
+    rows = {port: decode_stream_into(histories[port], chunks) for port, chunks in streams.items()}
+    decoded = time.monotonic() - started
+
+    detector = AnomalyDetector()
+    alerts = []
+    for port, history in histories.items():
+        for position in range(len(history)):
+            alerts.extend(detector.update(port, history.sample(position), history.voltages(position)))
+    return {'rows': rows, 'decoded_s': decoded, 'analysed_s': time.monotonic() - started - decoded,
+            'alerts': alerts}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay captured serial traffic through BssStation")
+    parser.add_argument('paths', nargs='+', help="capture files or directories")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--speed', type=float, default=0, help="1 for real time, 0 for as fast as possible")
+    parser.add_argument('--sink', action='store_true', help="write to the configured sink instead of discarding")
+    parser.add_argument('--decode', action='store_true',
+                        help="only decode the recorded battery replies into history and run the anomaly checks")
+    parser.add_argument('--history-size', type=int, default=86400, help="rows kept per port with --decode")
+    args = parser.parse_args()
+
+    paths = capture_paths(args.paths)
+    if args.decode:
+        result = decode(paths, args.history_size)
+        total = sum(result['rows'].values())
+        for port, rows in result['rows'].items():
+            print(f"{port}: {rows} rows")
+        print(f"{total} rows decoded in {result['decoded_s']:.2f}s ({total / max(result['decoded_s'], 1e-9):.0f}/s), "
+              f"{len(result['alerts'])} alerts in {result['analysed_s']:.2f}s")
+        for alert in result['alerts']:
+            print(alert.to_dict())
+        return
+    result = await replay(paths, load_config(args.config), args.speed, args.sink)
+    print(f"{len(paths)} files, {result['records']} records covering {result['captured_s']:.1f}s "
+          f"replayed in {result['replayed_s']:.2f}s")
+    print(f"{result['answered']} requests answered, {result['unmatched']} unmatched, {result['left']} left over, "
+          f"{result['samples']} samples ({result['samples'] / max(result['replayed_s'], 1e-9):.0f}/s)")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
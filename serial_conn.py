@@ -1,25 +1,45 @@
 import asyncio
 import aioserial
 from bms import BmsSample
-from typing import List
+from typing import Any, Dict, List, Optional
 from util import get_logger
+from metrics import SERIAL_ROUND_TRIP, SERIAL_TIMEOUTS
+import time
+
+
+class Transaction:
+    __slots__ = ('request', 'key', 'timeout', 'future')
+
+    def __init__(self, request: bytes, key: Any, timeout: float, future: asyncio.Future):
+        self.request = request
+        self.key = key
+        self.timeout = timeout
+        self.future = future
+
 
 class SerialConnection:
 
     logger = get_logger(__name__)
 
-    def __init__(self, port: str = 'COM9', baudrate: int = 9600 , timeout = 0.5):
+    # Port read timeout; None reads with the transaction timeout itself
+    READ_TIMEOUT: Optional[float] = None
+
+    def __init__(self, port: str = 'COM9', baudrate: int = 9600 , timeout = 0.5, serial_factory=aioserial.AioSerial):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        self.read_timeout = timeout if self.READ_TIMEOUT is None else min(self.READ_TIMEOUT, timeout)
+        self.serial_factory = serial_factory
         self.serial = None
+        self._transactions: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
 
     async def connect(self):
         self.logger.info('Serial Port Connection Attempt :')
         try:
-            self.serial = aioserial.AioSerial(port= self.port, 
+            self.serial = self.serial_factory(port= self.port, 
                                         baudrate = self.baudrate,
-                                        timeout = self.timeout)
+                                        timeout = self.read_timeout)
             return True
         except aioserial.SerialException as e:
             self.logger.info(f" - failed to connect to {self.port} - {str(e)}")
@@ -27,11 +47,59 @@ class SerialConnection:
         
         
     def disconnect(self):
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
         if self.serial:
             self.serial.close()
             self.logger.info(f"Disconnected from {self.port}")
     
 
+    async def transact(self, request: bytes, key: Any = None, timeout: Optional[float] = None):
+        # Every write on the port goes through this queue so only one request is ever in flight;
+        # key identifies the expected response (None for fire-and-forget writes)
+        if self._worker is None or self._worker.done():
+            self._transactions = asyncio.Queue()
+            self._worker = asyncio.create_task(self._transaction_worker())
+        future = asyncio.get_running_loop().create_future()
+        await self._transactions.put(Transaction(request, key, self.timeout if timeout is None else timeout, future))
+        return await future
+
+    async def _transaction_worker(self):
+        while True:
+            tx: Transaction = await self._transactions.get()
+            if tx.future.done():
+                continue
+            try:
+                self.reset_input()
+                started = time.perf_counter()
+                await self.serial.write_async(tx.request)
+                result = None
+                if tx.key is not None:
+                    result = await asyncio.wait_for(self.read_response(tx.key), tx.timeout)
+                    SERIAL_ROUND_TRIP.observe(time.perf_counter() - started, port=self.port)
+                if not tx.future.done():
+                    tx.future.set_result(result)
+            except asyncio.TimeoutError:
+                SERIAL_TIMEOUTS.inc(port=self.port)
+                self.logger.warning("No response for %s on %s within %ss", tx.key, self.port, tx.timeout)
+                if not tx.future.done():
+                    tx.future.set_result(None)
+                # The cancelled read goes on in aioserial's executor thread until the port timeout;
+                # let it return before the next request so it can't take that reply's bytes
+                await asyncio.sleep(self.read_timeout)
+            except Exception as e:
+                if not tx.future.done():
+                    tx.future.set_exception(e)
+
+    def reset_input(self):
+        # Late bytes of an earlier reply that timed out
+        self.serial.reset_input_buffer()
+
+    async def read_response(self, key: Any):
+
+        raise NotImplementedError()
+
     async def fetch_basic(self) -> BmsSample:
 
         raise NotImplementedError()
@@ -41,7 +109,7 @@ class SerialConnection:
         raise NotImplementedError()
 
 
-    async def set_switch(self, switch: str, state: bool):
+    async def set_switch(self, switch: str, state: bool, switches: Optional[Dict[str, bool]] = None):
 
         raise NotImplementedError()
     
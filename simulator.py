@@ -0,0 +1,191 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, Optional
+from jbd import jbd_checksum
+
+
+class SimulatedSerial:
+    """In-memory stand-in for aioserial.AioSerial.
+
+    Whatever the station writes goes to ``device.handle(data)``; the device
+    answers by calling ``feed``. Reads honour the port timeout like pyserial,
+    and ``byte_time`` adds the wire time of the reply (1/960 s at 9600 baud).
+    """
+
+    def __init__(self, device, port: str = 'SIM', baudrate: int = 9600, timeout: Optional[float] = 1, **kwargs):
+        self.device = device
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.byte_time = 10 / baudrate if baudrate else 0
+        self.is_open = True
+        self._rx = bytearray()
+        self._data_ready = asyncio.Event()
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def feed(self, data: bytes):
+        self._rx += data
+        self._data_ready.set()
+
+    async def _wait(self, predicate) -> bool:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not predicate():
+            self._data_ready.clear()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._data_ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        self.bytes_read += len(data)
+        return data
+
+    async def write_async(self, data: bytes) -> int:
+        self.bytes_written += len(data)
+        await self.device.handle(self, bytes(data))
+        return len(data)
+
+    async def read_async(self, size: int = 1) -> bytes:
+        await self._wait(lambda: len(self._rx) >= size)
+        data = self._take(size)
+        if self.byte_time:
+            await asyncio.sleep(len(data) * self.byte_time)
+        return data
+
+    async def readline_async(self, size: int = -1) -> bytes:
+        await self._wait(lambda: b'\n' in self._rx)
+        end = self._rx.find(b'\n')
+        return self._take(len(self._rx) if end < 0 else end + 1)
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class SimulatedJbdPack:
+    """A JBD pack answering 0x03 basic info, 0x04 cell voltages and 0xE1 switch writes."""
+
+    def __init__(self, num_cells: int = 16, soc: float = 50.0, current: float = 10.0, capacity: float = 100.0,
+                 num_temps: int = 2, latency: float = 0.02, present: bool = True):
+        self.num_cells = num_cells
+        self.soc = soc
+        self.current = current
+        self.capacity = capacity
+        self.num_temps = num_temps
+        self.latency = latency
+        self.present = present
+        self.mos_state = 0x03
+        self.num_cycles = random.randint(0, 500)
+        self._last_update = time.monotonic()
+
+    def _advance(self):
+        now = time.monotonic()
+        elapsed, self._last_update = now - self._last_update, now
+        self.soc = min(100.0, self.soc + self.current * elapsed / 3600 / self.capacity * 100)
+        if self.soc >= 100.0:
+            self.current = 0.0
+
+    def cell_voltages(self) -> List[int]:
+        base = 3000 + int(self.soc * 5)
+        return [base + random.randint(-5, 5) for _ in range(self.num_cells)]
+
+    def basic_payload(self) -> bytes:
+        self._advance()
+        voltage = sum(self.cell_voltages()) // 10
+        payload = bytearray(23 + 2 * self.num_temps)
+        payload[0:2] = voltage.to_bytes(2, 'big')
+        payload[2:4] = int(self.current * 100).to_bytes(2, 'big', signed=True)
+        payload[4:6] = int(self.soc * self.capacity).to_bytes(2, 'big')
+        payload[6:8] = int(self.capacity * 100).to_bytes(2, 'big')
+        payload[8:10] = self.num_cycles.to_bytes(2, 'big')
+        payload[19] = int(self.soc)
+        payload[20] = self.mos_state
+        payload[21] = self.num_cells
+        payload[22] = self.num_temps
+        for i in range(self.num_temps):
+            temperature = 2731 + 250 + int(self.current * 5) + random.randint(-5, 5)
+            payload[23 + 2 * i:25 + 2 * i] = temperature.to_bytes(2, 'big')
+        return bytes(payload)
+
+    def voltage_payload(self) -> bytes:
+        return b''.join(v.to_bytes(2, 'big') for v in self.cell_voltages())
+
+    @staticmethod
+    def response(cmd: int, payload: bytes, status: int = 0x00) -> bytes:
+        body = bytes([status, len(payload)]) + payload
+        return bytes([0xDD, cmd]) + body + jbd_checksum(body).to_bytes(2, 'big') + b'\x77'
+
+    async def handle(self, serial: SimulatedSerial, data: bytes):
+        if not self.present or len(data) < 7 or data[0] != 0xDD:
+            return
+        cmd = data[2]
+        if cmd == 0x03:
+            reply = self.response(cmd, self.basic_payload())
+        elif cmd == 0x04:
+            reply = self.response(cmd, self.voltage_payload())
+        elif cmd == 0xE1:
+            self.mos_state = {0x00: 0x03, 0x01: 0x02, 0x02: 0x01, 0x03: 0x00}.get(data[5], self.mos_state)
+            reply = self.response(cmd, b'')
+        else:
+            return
+        asyncio.get_running_loop().call_later(self.latency, serial.feed, reply)
+
+
+class SimulatedControllino:
+    """Speaks the Controllino.ino text protocol: limit switch events out, relay triggers in."""
+
+    def __init__(self, latency: float = 0.005):
+        self.latency = latency
+        self.serial: Optional[SimulatedSerial] = None
+        self.triggered: List[int] = []
+        self.on_trigger: Optional[Callable[[int], None]] = None
+
+    def activate_switch(self, switch: int):
+        self.serial.feed(f"Limit switch {switch} activated\r\n".encode())
+
+    async def handle(self, serial: SimulatedSerial, data: bytes):
+        message = data.decode().strip()
+        if message.startswith("Trigger Relay "):
+            relay = int(message[14:])
+            self.triggered.append(relay)
+            if self.on_trigger:
+                self.on_trigger(relay)
+            reply = f"Triggered Relay {relay} successfully\r\n"
+        else:
+            reply = f"Invalid command: {message}\r\n"
+        asyncio.get_running_loop().call_later(self.latency, serial.feed, reply.encode())
+
+
+class SimulatedStationHardware:
+    """Port name to simulated device map, usable as the serial_factory of SerialConnection and BssStation."""
+
+    def __init__(self, control_port: str = 'SIM_CONTROL'):
+        self.control_port = control_port
+        self.controllino = SimulatedControllino()
+        self.packs: Dict[str, SimulatedJbdPack] = {}
+        self.ports: Dict[str, SimulatedSerial] = {}
+
+    def add_pack(self, port: str, **kwargs) -> SimulatedJbdPack:
+        self.packs[port] = SimulatedJbdPack(**kwargs)
+        return self.packs[port]
+
+    def __call__(self, port: str, baudrate: int = 9600, timeout: Optional[float] = 1, **kwargs) -> SimulatedSerial:
+        if port == self.control_port:
+            device = self.controllino
+        else:
+            device = self.packs.setdefault(port, SimulatedJbdPack())
+        serial = SimulatedSerial(device, port, baudrate, timeout)
+        if device is self.controllino:
+            self.controllino.serial = serial
+        self.ports[port] = serial
+        return serial
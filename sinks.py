@@ -1,74 +1,471 @@
 import asyncio
-from influxdb_client_3 import InfluxDBClient3, Point, flight_client_options
-from typing import List, Dict
+import gzip
+import math
+import os
+import random
+import shutil
+import ssl
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Optional, Tuple
+from urllib.parse import urlencode
 from bms import BmsSample 
+from line_protocol import LineProtocolEncoder
 from util import get_logger
-import certifi
+from metrics import REGISTRY, SINK_BATCH_SIZE, SINK_FAILURES, SINK_WRITE
 import concurrent.futures
 from functools import partial
-import time
 import json
+import zlib
+
+def load_config(path='config.json'):
+    with open(path, 'r') as config_file:
+        return json.load(config_file)
+
+
+def create_client(sink_config: Dict) -> 'InfluxDBClient3':
+    # The client and certifi pull in pyarrow/Flight; imported here so sinks.py stays cheap to import
+    import certifi
+    from influxdb_client_3 import InfluxDBClient3, flight_client_options
+
+    with open(certifi.where(), "r") as fh:
+        cert = fh.read()
+
+    url = sink_config['url']
+    token = sink_config['token'] 
+    org = sink_config['org']
+    bucket = sink_config['bucket']
+
+    return InfluxDBClient3(
+        host=url, 
+        token=token, 
+        org=org, 
+        database=bucket,
+        flight_client_options=flight_client_options(tls_root_certs=cert)
+    )
+
+
+class PermanentWriteError(Exception):
+    """The backend refused the data itself (malformed line protocol); retrying or spilling won't help."""
 
-with open('config.json', 'r') as config_file:
-        config = json.load(config_file)
 
-class InfluxDBSink:
+class BatchTooLargeError(Exception):
+    """The request was over the backend's size limit; smaller batches may still go through."""
+
+
+class AsyncInfluxWriter:
+    """Non-blocking line-protocol writes over the InfluxDB HTTP write API.
+
+    One keep-alive session, at most ``max_in_flight`` concurrent requests,
+    explicit timeouts, and retries with full-jitter exponential backoff on
+    network errors, 408, 429 and 5xx. Other refusals aren't retried here; only
+    malformed data (400, 422) is dropped, anything else such as an expired
+    token or a wrong bucket fails the batch so it is spilled.
+    """
 
     logger = get_logger(__name__)
 
-    def __init__(self):
-        with open(certifi.where(), "r") as fh:
-            cert = fh.read()
-            
-        sink_config = config['sink_config']
+    RETRYABLE = {408, 429, 500, 502, 503, 504}
+    MALFORMED = {400, 422}
+
+    def __init__(self, sink_config: Dict):
         url = sink_config['url']
-        token = sink_config['token'] 
-        org = sink_config['org']
-        bucket = sink_config['bucket']
-
-        self.client = InfluxDBClient3(
-            host=url, 
-            token=token, 
-            org=org, 
-            database=bucket,
-            flight_client_options=flight_client_options(tls_root_certs=cert)
-        )
-        self.executor = concurrent.futures.ThreadPoolExecutor()
-
-    def create_sample_point(self, id: int, sample: BmsSample):
-        sample_dict = sample.to_dict()
-        point = Point("sample").tag("battery_id", id)
-
-        for field_key, field_value in sample_dict.items():
-            point = point.field(field_key, field_value)
-        if len(sample_dict) > 1:
-            self.logger.info(f"Create data point for Battery ID {id}")
-        return point
-    
-    def create_voltage_point(self, id: int, voltages: List[float]):
-        voltage_cells = {f"cell{i+1}": float(v) for i, v in enumerate(voltages)}
-        point = Point("voltage").tag("battery_id", id).field("timestamp", int(time.time()))
-
-        for field_key, field_value in voltage_cells.items():
-            point = point.field(field_key, field_value)
-        return point
+        if '://' not in url:
+            url = f'https://{url}'
+        self.url = url.rstrip('/') + '/api/v2/write'
+        self.params = {'org': sink_config['org'], 'bucket': sink_config['bucket'], 'precision': 'ns'}
+        self.headers = {'Authorization': f"Token {sink_config['token']}",
+                        'Content-Type': 'text/plain; charset=utf-8',
+                        'Content-Encoding': 'gzip'}
+        self.write_timeout = sink_config.get('write_timeout', 10)
+        self.connect_timeout = sink_config.get('connect_timeout', 5)
+        self.cafile = None
+        self.max_in_flight = sink_config.get('max_in_flight', 2)
+        self.retries = sink_config.get('write_retries', 3)
+        self.backoff_base = sink_config.get('backoff_base', 0.5)
+        self.backoff_max = sink_config.get('backoff_max', 30)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._session: Optional['aiohttp.ClientSession'] = None
 
-    async def publish_sample(self, samples_dict: Dict[int, BmsSample]):
-        data_points = [self.create_sample_point(id, sample) for id, sample in samples_dict.items()]
+    def prepare(self):
+        # Blocking imports, run off the event loop before the first write
+        import aiohttp
+        import certifi
+        self.cafile = certifi.where()
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+        if self.cafile is None:
+            self.prepare()
+        if self._session is None or self._session.closed:
+            timeout = aiohttp.ClientTimeout(total=self.write_timeout, connect=self.connect_timeout)
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60,
+                                             ssl=ssl.create_default_context(cafile=self.cafile))
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def write(self, lines: List[str]):
+        import aiohttp
+        body = gzip.compress('\n'.join(lines).encode(), compresslevel=5)
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                delay = self._backoff(attempt)
+                try:
+                    async with self._get_session().post(self.url, params=self.params, data=body,
+                                                        headers=self.headers) as response:
+                        if response.status < 300:
+                            return
+                        error = f"HTTP {response.status}: {await response.text()}"
+                        if response.status in self.MALFORMED:
+                            raise PermanentWriteError(error)
+                        if response.status == 413:
+                            raise BatchTooLargeError(error)
+                        if response.status not in self.RETRYABLE:
+                            raise ConnectionError(error)
+                        retry_after = response.headers.get('Retry-After')
+                        if retry_after and retry_after.isdigit():
+                            delay = max(delay, int(retry_after))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = f"{type(e).__name__}: {e}"
+                if attempt == self.retries:
+                    raise ConnectionError(error)
+                self.logger.warning(f"Write attempt {attempt + 1} failed ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+
+class SpillFile:
+    """Append-only line-protocol file holding points the backend could not take.
+
+    A replay first moves the file aside to ``<path>.replay`` and reads that one
+    in batches, so points spilled meanwhile start a fresh file instead of
+    waiting for the replay to finish.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.replay_path = path + '.replay'
+
+    @staticmethod
+    def _has_data(path: str) -> bool:
+        return os.path.exists(path) and os.path.getsize(path) > 0
+
+    def exists(self) -> bool:
+        return self._has_data(self.path) or self._has_data(self.replay_path)
+
+    def append(self, lines: List[str]):
+        with open(self.path, 'a', encoding='utf-8') as fh:
+            fh.write('\n'.join(lines) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def claim(self) -> bool:
+        # A replay file left by an earlier failed replay is older than the spill file, so it goes first
+        if self._has_data(self.replay_path):
+            return True
+        if not self._has_data(self.path):
+            return False
+        os.replace(self.path, self.replay_path)
+        return True
+
+    def read_batch(self, offset: int, size: int) -> Tuple[List[str], int]:
+        # Up to size lines of the replay file starting at byte offset, and the offset after them
+        lines = []
+        with open(self.replay_path, 'rb') as fh:
+            fh.seek(offset)
+            while len(lines) < size:
+                line = fh.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8').rstrip('\n')
+                if line:
+                    lines.append(line)
+            return lines, fh.tell()
+
+    def trim(self, offset: int):
+        # Drops the replayed part of the replay file, removing it once everything was sent
+        with open(self.replay_path, 'rb') as fh:
+            fh.seek(offset)
+            if not fh.read(1):
+                fh.close()
+                os.remove(self.replay_path)
+                return
+            fh.seek(offset)
+            tmp_path = self.replay_path + '.tmp'
+            with open(tmp_path, 'wb') as out:
+                shutil.copyfileobj(fh, out)
+        os.replace(tmp_path, self.replay_path)
+
+
+class BufferedSink:
+    """Write-behind pipeline shared by the sinks: encode, buffer, flush in batches, spill on failure.
+
+    Subclasses only implement ``write_lines``.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, sink_config: Dict, encoder: Optional[LineProtocolEncoder] = None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.encoder = encoder or LineProtocolEncoder()
+
+        # Write-behind buffer: points are flushed when batch_size is reached or every flush_interval seconds,
+        # and go to the spill file when the backend is down or the buffer is full
+        self.batch_size = sink_config.get('batch_size', 500)
+        self.flush_interval = sink_config.get('flush_interval', 10)
+        self.max_buffer = sink_config.get('max_buffer', 10000)
+        self.close_timeout = sink_config.get('close_timeout', 10)
+        self.spill = SpillFile(sink_config.get('spill_path', 'influx_spill.lp'))
+        self.buffer = deque()
+        self.backend_up = True
+        self._spill_lock = asyncio.Lock()
+        self._replaying = False
+        self._flush_event = None
+        self._flusher = None
+        self._closing = False
+        self._ready: Optional[asyncio.Task] = None
+        self.ready_at: Optional[float] = None
+        REGISTRY.gauge('sink_buffered_points', 'Points waiting in the sink buffer',
+                       callback=lambda: [({'sink': type(self).__name__}, len(self.buffer))])
+
+    async def write_lines(self, lines: List[str]):
+
+        raise NotImplementedError()
+
+    def prepare(self):
+        """Blocking client setup (imports, TLS, connections), run on the executor before the first write."""
+
+    def start(self) -> asyncio.Task:
+        # Prepares the backend in the background; points keep buffering until it's done
+        if self._ready is None:
+            self._ready = asyncio.create_task(self._prepare())
+        return self._ready
+
+    async def _prepare(self):
+        started = time.monotonic()
         try:
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(self.executor, partial(self.client.write, record=data_points))
-            self.logger.info("Sample data points written successfully.")
+            await self._run(self.prepare)
         except Exception as e:
-            self.logger.error(f"Failed to write sample data points: {e}")
+            # Writes fail and spill until the backend can be reached
+            self.logger.error(f"Failed to prepare {type(self).__name__}: {e}")
+        self.ready_at = time.monotonic()
+        self.logger.info(f"{type(self).__name__} ready in {(self.ready_at - started) * 1000:.0f} ms")
+
+    def create_sample_point(self, id: int, sample: BmsSample) -> str:
+        return self.encoder.encode_sample(id, sample)
+
+    def create_voltage_point(self, id: int, voltages: List[float]) -> str:
+        return self.encoder.encode_voltages(id, voltages)
+
+    async def publish_sample(self, samples_dict: Dict[int, BmsSample]):
+        for id, sample in samples_dict.items():
+            if not math.isnan(sample.voltage):
+                self.logger.info("Create data point for Battery ID %s", id)
+        await self.enqueue(self.encoder.encode_samples(samples_dict))
 
     async def publish_voltage(self, voltages_dict: Dict[int, List[float]]):
-        voltage_points = [self.create_voltage_point(id, voltages) for id, voltages in voltages_dict.items()]
+        await self.enqueue(self.encoder.encode_voltages_batch(voltages_dict))
+
+    async def enqueue(self, lines: List[str]):
+        if self._flusher is None or self._flusher.done():
+            self._flush_event = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+        self.buffer.extend(lines)
+        overflow = len(self.buffer) - self.max_buffer
+        if overflow > 0:
+            # Backpressure: move the oldest points to disk instead of dropping them
+            spilled = [self.buffer.popleft() for _ in range(overflow)]
+            await self._spill(spilled)
+            self.logger.warning(f"Write buffer full, spilled {overflow} points to {self.spill.path}")
+        if len(self.buffer) >= self.batch_size:
+            self._flush_event.set()
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def _spill(self, lines: List[str]):
+        async with self._spill_lock:
+            await self._run(self.spill.append, lines)
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    async def flush(self):
+        await self.start()
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                written = await self._write_batch(batch)
+            except asyncio.CancelledError:
+                # The batch is already out of the buffer; keep it on disk rather than lose it
+                await self._spill(batch)
+                raise
+            if not written:
+                await self._spill(batch)
+                self.logger.warning(f"Spilled {len(batch)} points to {self.spill.path}")
+                break
+        if self.backend_up and self.spill.exists():
+            await self.replay_spill()
+
+    async def _write_batch(self, lines: List[str]) -> bool:
+        SINK_BATCH_SIZE.observe(len(lines))
         try:
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(self.executor, partial(self.client.write, record=voltage_points))
-            self.logger.info("Voltage data points written successfully.")
+            with SINK_WRITE.time():
+                await self.write_lines(lines)
+            self.logger.info("%d data points written successfully.", len(lines))
+            self.backend_up = True
+        except PermanentWriteError as e:
+            # Spilling a batch the backend will never accept would replay it forever
+            self.logger.error(f"Dropping {len(lines)} data points rejected by the backend: {e}")
+            return True
+        except BatchTooLargeError as e:
+            if len(lines) == 1:
+                self.logger.error(f"Dropping a data point larger than the backend accepts: {e}")
+                return True
+            # Halve the batch until it fits; rewriting the points of a half that went through is idempotent
+            half = len(lines) // 2
+            return await self._write_batch(lines[:half]) and await self._write_batch(lines[half:])
         except Exception as e:
-            self.logger.error(f"Failed to write voltage data points: {e}")
+            SINK_FAILURES.inc()
+            if self.backend_up:
+                self.logger.error(f"Failed to write data points: {e}")
+            self.backend_up = False
+        return self.backend_up
+
+    async def replay_spill(self):
+        # The spill lock is only held to move the file aside, never across a write, so enqueue
+        # can keep spilling overflow while the backlog is sent
+        if self._replaying:
+            return
+        self._replaying = True
+        try:
+            async with self._spill_lock:
+                if not await self._run(self.spill.claim):
+                    return
+            self.logger.info(f"Replaying spilled points from {self.spill.replay_path}")
+            offset = sent = 0
+            try:
+                while True:
+                    batch, end = await self._run(self.spill.read_batch, offset, self.batch_size)
+                    if not batch:
+                        offset = end
+                        break
+                    if not await self._write_batch(batch):
+                        break
+                    offset = end
+                    sent += len(batch)
+            finally:
+                # Whatever wasn't sent stays in the replay file for the next attempt
+                await self._run(self.spill.trim, offset)
+            self.logger.info(f"Replayed {sent} spilled points")
+        finally:
+            self._replaying = False
+
+    async def close(self):
+        if self._flusher:
+            # Let an in-flight write finish; one outlasting close_timeout is cancelled and its batch spilled
+            self._closing = True
+            self._flush_event.set()
+            try:
+                await asyncio.wait_for(self._flusher, self.close_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._flusher = None
+        await self.flush()
+        if self.buffer:
+            await self._spill(list(self.buffer))
+            self.buffer.clear()
+
+
+class InfluxDBSink(BufferedSink):
+
+    logger = get_logger(__name__)
+
+    def __init__(self, sink_config: Optional[Dict] = None):
+        self.sink_config = sink_config or load_config()['sink_config']
+        self.writer = AsyncInfluxWriter(self.sink_config)
+        self._client = None
+        self._client_lock = threading.Lock()
+        super().__init__(self.sink_config)
+
+    @property
+    def client(self):
+        # Flight client for queries, built on first use; writes go through the non-blocking HTTP writer
+        with self._client_lock:
+            if self._client is None:
+                self._client = create_client(self.sink_config)
+        return self._client
+
+    def prepare(self):
+        self.writer.prepare()
+        self.client
+
+    async def write_lines(self, lines: List[str]):
+        await self.writer.write(lines)
+
+    async def close(self):
+        await super().close()
+        await self.writer.close()
+
+
+class GatewaySink(BufferedSink):
+    """Sends batches to a fleet gateway (gateway.py) over one persistent websocket.
+
+    Each batch is zlib-compressed line protocol tagged with the station id; the
+    gateway acknowledges it only after writing it, so unacknowledged batches stay
+    in the buffer/spill file like any other failed write.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, gateway_config: Dict):
+        self.url = gateway_config['url']
+        self.station_id = gateway_config['station_id']
+        self.token = gateway_config.get('token', '')
+        self.ack_timeout = gateway_config.get('ack_timeout', 10)
+        self.connection = None
+        super().__init__(gateway_config, LineProtocolEncoder(tags={'station': self.station_id}))
+
+    def prepare(self):
+        import websockets
+
+    async def connect(self):
+        import websockets
+        query = urlencode({'station': self.station_id, 'token': self.token})
+        self.connection = await websockets.connect(f"{self.url}?{query}", max_size=None)
+        self.logger.info(f"Connected to gateway {self.url}")
+
+    async def write_lines(self, lines: List[str]):
+        if self.connection is None:
+            await self.connect()
+        try:
+            await self.connection.send(zlib.compress('\n'.join(lines).encode()))
+            ack = json.loads(await asyncio.wait_for(self.connection.recv(), self.ack_timeout))
+        except Exception:
+            # Drop the connection so the next flush reconnects
+            connection, self.connection = self.connection, None
+            await connection.close()
+            raise
+        if not ack.get('ok'):
+            raise RuntimeError(f"Gateway rejected batch: {ack.get('error')}")
 
 
+def create_sink(config: Dict) -> BufferedSink:
+    if 'gateway_config' in config:
+        return GatewaySink(config['gateway_config'])
+    return InfluxDBSink(config.get('sink_config'))
@@ -0,0 +1,113 @@
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from bms import BmsSample
+from util import get_logger
+
+
+def sample_to_json(sample: BmsSample) -> str:
+    return json.dumps({key: getattr(sample, key) for key in BmsSample.__slots__})
+
+
+def sample_from_json(data: str) -> BmsSample:
+    return BmsSample(**json.loads(data))
+
+
+class StationStore:
+    """SQLite (WAL) checkpoint of slot occupancy, last samples and swap history.
+
+    Only slots marked dirty since the last checkpoint are written, all in one
+    transaction; swap transitions are appended as they happen.
+    """
+
+    logger = get_logger(__name__)
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS slots (
+            slot_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            sample TEXT,
+            voltages TEXT,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS swap_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            slot_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    def __init__(self, path: str = 'station_state.db', checkpoint_interval: float = 5):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL only syncs on WAL checkpoints, so commits don't wait on the disk
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self._dirty: Dict[int, Tuple[str, Optional[BmsSample], Optional[List[float]]]] = {}
+        self._last_checkpoint = time.monotonic()
+
+    def load(self) -> Dict[int, Tuple[str, Optional[BmsSample], List[float]]]:
+        slots = {}
+        for slot_id, state, sample, voltages in self.conn.execute('SELECT slot_id, state, sample, voltages FROM slots'):
+            slots[slot_id] = (state,
+                              sample_from_json(sample) if sample else None,
+                              json.loads(voltages) if voltages else [])
+        return slots
+
+    def get_meta(self, key: str, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def mark_dirty(self, slot_id: int, state: str, sample: Optional[BmsSample] = None,
+                   voltages: Optional[Iterable[float]] = None):
+        _, dirty_sample, dirty_voltages = self._dirty.get(slot_id, (None, None, None))
+        self._dirty[slot_id] = (state,
+                                sample if sample is not None else dirty_sample,
+                                list(voltages) if voltages is not None else dirty_voltages)
+
+    def record_transition(self, slot_id: int, state: str):
+        with self.conn:
+            self.conn.execute('INSERT INTO swap_history (slot_id, state, at) VALUES (?, ?, ?)',
+                              (slot_id, state, time.time()))
+
+    def swap_history(self, limit: int = 100) -> List[Tuple[int, str, float]]:
+        return self.conn.execute('SELECT slot_id, state, at FROM swap_history ORDER BY id DESC LIMIT ?',
+                                 (limit,)).fetchall()
+
+    def checkpoint(self, force: bool = False) -> int:
+        if not self._dirty or (not force and time.monotonic() - self._last_checkpoint < self.checkpoint_interval):
+            return 0
+        now = time.time()
+        rows = [(slot_id, state,
+                 sample_to_json(sample) if sample is not None else None,
+                 json.dumps(voltages) if voltages is not None else None,
+                 now)
+                for slot_id, (state, sample, voltages) in self._dirty.items()]
+        with self.conn:
+            # Keep the stored sample when only the state changed
+            self.conn.executemany('''
+                INSERT INTO slots (slot_id, state, sample, voltages, updated) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(slot_id) DO UPDATE SET
+                    state = excluded.state,
+                    sample = COALESCE(excluded.sample, slots.sample),
+                    voltages = COALESCE(excluded.voltages, slots.voltages),
+                    updated = excluded.updated''', rows)
+        self._dirty.clear()
+        self._last_checkpoint = time.monotonic()
+        return len(rows)
+
+    def close(self):
+        self.checkpoint(force=True)
+        self.conn.close()
@@ -0,0 +1,206 @@
+import asyncio
+import time
+from enum import Enum
+from typing import Callable, Dict, List, Optional
+from bms import BmsSample
+from charging import ChargeEstimator, ReadyQueue
+from util import get_logger
+
+
+class SlotState(Enum):
+    EMPTY = 'empty'
+    INSERTED = 'inserted'
+    IDENTIFIED = 'identified'
+    CHARGING = 'charging'
+    READY = 'ready'
+    EJECTING = 'ejecting'
+
+
+class SwapSlot:
+
+    def __init__(self, slot_id: int):
+        self.slot_id = slot_id
+        self.state = SlotState.EMPTY
+        self.since = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+    def set_state(self, state: SlotState):
+        self.state = state
+        self.since = time.monotonic()
+
+
+class SwapManager:
+    """Per-slot swap state machine: inserted -> identified -> charging -> ready -> ejecting.
+
+    Controllino events and BMS answers move each slot along independently; every
+    wait has a timeout and a retry budget, and nothing here holds the station lock
+    across serial I/O, so several swaps can run while telemetry keeps flowing.
+
+    Charging and ready packs sit in a queue ordered by predicted time-to-full, so
+    a customer arriving at a full station is held for up to ``hold_time`` seconds
+    when a pack is about to finish instead of being turned away.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self, station, max_soc: float = 90, identify_retries: int = 10, retry_delay: float = 1,
+                 eject_delay: float = 3, eject_timeout: float = 2, eject_retries: int = 3,
+                 hold_time: float = 300, estimate_window: float = 600):
+        self.station = station
+        self.max_soc = max_soc
+        self.identify_retries = identify_retries
+        self.retry_delay = retry_delay
+        self.eject_delay = eject_delay
+        self.eject_timeout = eject_timeout
+        self.eject_retries = eject_retries
+        self.hold_time = hold_time
+        self.estimator = ChargeEstimator(max_soc, station.history, window=estimate_window)
+        self.queue = ReadyQueue()
+        self._ready_event: Optional[asyncio.Event] = None
+        self.slots: Dict[int, SwapSlot] = {slot_id: SwapSlot(slot_id) for slot_id in station.scheduler.slots}
+        self._relay_acks: Dict[int, asyncio.Future] = {}
+        self.on_state_change: Optional[Callable[[int, SlotState], None]] = None
+
+    def state(self, slot_id: int) -> SlotState:
+        return self.slots[slot_id].state
+
+    def occupied(self) -> List[int]:
+        return [slot_id for slot_id, slot in self.slots.items() if slot.state is not SlotState.EMPTY]
+
+    def ready(self) -> List[int]:
+        return [slot_id for slot_id, slot in self.slots.items() if slot.state is SlotState.READY]
+
+    def estimates(self) -> List:
+        # (slot_id, seconds to full) of charging and ready packs, soonest first
+        return self.queue.items()
+
+    def restore(self, slot_id: int, state: SlotState):
+        self.slots[slot_id].set_state(state)
+        self._requeue(slot_id, state)
+
+    def _requeue(self, slot_id: int, state: SlotState):
+        if state is SlotState.READY:
+            self.queue.update(slot_id, 0.0)
+            if self._ready_event:
+                self._ready_event.set()
+        elif state is SlotState.CHARGING:
+            self.queue.update(slot_id, self.estimator.time_to_full(slot_id))
+        else:
+            self.queue.remove(slot_id)
+
+    def _set(self, slot: SwapSlot, state: SlotState):
+        slot.set_state(state)
+        self._requeue(slot.slot_id, state)
+        if self.on_state_change:
+            self.on_state_change(slot.slot_id, state)
+
+    def _spawn(self, slot: SwapSlot, coro):
+        slot.task = asyncio.create_task(coro)
+
+    def on_limit_switch(self, slot_id: int):
+        slot = self.slots.get(slot_id)
+        if slot is None:
+            self.logger.warning(f"Limit switch for unknown slot {slot_id}")
+            return
+        if slot.state not in (SlotState.EMPTY, SlotState.EJECTING):
+            self.logger.info(f"Slot {slot_id} is already {slot.state.value}, ignoring limit switch")
+            return
+        self.logger.info(f"Detect new Battery from slot {slot_id}")
+        if slot.state is SlotState.EJECTING:
+            # The new pack replaces the one being ejected; the eject must not release it when it finishes
+            if slot.task is not None and not slot.task.done():
+                slot.task.cancel()
+            self.station.release_slot(slot_id)
+        self._set(slot, SlotState.INSERTED)
+        self._spawn(slot, self._identify(slot))
+
+    def on_relay_ack(self, slot_id: int):
+        future = self._relay_acks.get(slot_id)
+        if future and not future.done():
+            future.set_result(True)
+
+    def on_sample(self, slot_id: int, sample: BmsSample):
+        slot = self.slots[slot_id]
+        if sample.soc is None:
+            return
+        if slot.state is SlotState.CHARGING and sample.soc >= self.max_soc:
+            self._set(slot, SlotState.READY)
+            self.logger.info(f"Battery in slot {slot_id} is ready ({sample.soc}%)")
+        elif slot.state is SlotState.READY and sample.soc < self.max_soc:
+            self._set(slot, SlotState.CHARGING)
+        elif slot.state is SlotState.CHARGING:
+            self.queue.update(slot_id, self.estimator.time_to_full(slot_id))
+
+    async def _wait_for_ready(self, slot: SwapSlot) -> Optional[int]:
+        # The slot to hand out: a ready pack now, or one predicted to be ready within hold_time
+        deadline = time.monotonic() + self.hold_time
+        if self._ready_event is None:
+            self._ready_event = asyncio.Event()
+        while True:
+            best = self.queue.peek()
+            remaining = deadline - time.monotonic()
+            if best is not None and best[1] == 0:
+                return best[0]
+            if best is None or best[1] > remaining:
+                return None
+            self.logger.info(f"Holding battery in slot {slot.slot_id}, slot {best[0]} "
+                             f"expected ready in {best[1]:.0f}s")
+            self._ready_event.clear()
+            try:
+                # Wake on the next ready pack, or re-check the refreshed estimates
+                await asyncio.wait_for(self._ready_event.wait(), min(remaining, self.retry_delay * 10))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _identify(self, slot: SwapSlot):
+        bms = self.station.scheduler.slots[slot.slot_id].bms
+        for _ in range(self.identify_retries):
+            if await bms.probe():
+                break
+            await asyncio.sleep(self.retry_delay)
+        else:
+            self.logger.error(f"Battery in slot {slot.slot_id} did not answer, rejecting it")
+            await self.eject(slot.slot_id)
+            return
+
+        self._set(slot, SlotState.IDENTIFIED)
+        others = [slot_id for slot_id in self.occupied() if slot_id != slot.slot_id]
+        if len(others) >= self.station.MAX_BATTERIES - 1:
+            ready = await self._wait_for_ready(slot)
+            if ready is None:
+                self.logger.info("No avaiable batteries")
+                await self.eject(slot.slot_id)
+                return
+            # Claim the pack right away so a second held customer can't pick it too
+            self._set(self.slots[ready], SlotState.EJECTING)
+            self._spawn(self.slots[ready], self.eject(ready))
+
+        self._set(slot, SlotState.CHARGING)
+        self.station.accept_battery(slot.slot_id)
+
+    async def eject(self, slot_id: int) -> bool:
+        slot = self.slots[slot_id]
+        if slot.state is not SlotState.EJECTING:
+            self._set(slot, SlotState.EJECTING)
+        await asyncio.sleep(self.eject_delay)
+        loop = asyncio.get_running_loop()
+        try:
+            for _ in range(self.eject_retries):
+                self._relay_acks[slot_id] = loop.create_future()
+                relay = self.station.slot_to_relay(slot_id)
+                await self.station.send_control(f"Trigger Relay {relay}\n")
+                self.logger.info(f"Trying to trigger relay {relay} for slot {slot_id}")
+                try:
+                    await asyncio.wait_for(self._relay_acks[slot_id], self.eject_timeout)
+                    break
+                except asyncio.TimeoutError:
+                    self.logger.warning(f"No relay acknowledgement for slot {slot_id}, retrying")
+            else:
+                self.logger.error(f"Failed to remove battery from slot {slot_id}")
+                return False
+        finally:
+            self._relay_acks.pop(slot_id, None)
+
+        self._set(slot, SlotState.EMPTY)
+        self.station.release_slot(slot_id)
+        return True
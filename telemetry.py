@@ -0,0 +1,62 @@
+import asyncio
+import json
+import math
+from typing import Dict, List, Optional, Set
+from bms import BmsSample
+from util import get_logger
+from metrics import FANOUT
+
+
+class LiveTelemetry:
+    """Latest station state, serialized once and pushed to every subscriber on change.
+
+    Each subscriber gets a one-slot queue that always holds the newest payload,
+    so a slow websocket client skips stale states instead of backing up.
+    """
+
+    logger = get_logger(__name__)
+
+    def __init__(self):
+        self.version = 0
+        self.payload: Optional[str] = None
+        self._state = None
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        if self.payload is not None:
+            queue.put_nowait(self.payload)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, data) -> bool:
+        if data == self._state:
+            return False
+        self._state = data
+        self.version += 1
+        with FANOUT.time():
+            self.payload = json.dumps({"data": data})
+            for queue in self._subscribers:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(self.payload)
+        return True
+
+    def publish_samples(self, samples: Dict[int, BmsSample], voltages: Optional[Dict[int, List[float]]] = None) -> bool:
+        # Same row shape as the "sample" measurement: one row per occupied slot, battery_id as a string tag
+        rows = []
+        for battery_id, sample in samples.items():
+            if math.isnan(sample.voltage):
+                continue
+            row = {'battery_id': str(battery_id), **sample.to_dict()}
+            if voltages and voltages.get(battery_id):
+                row['cells'] = list(voltages[battery_id])
+            rows.append(row)
+        return self.publish(rows)
@@ -1,28 +1,146 @@
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import time
-import logging
+from collections import OrderedDict
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
+
+_level = logging.INFO
+_handlers = None
+_loggers = set()
+_listener = None
+
+
+class StationFormatter(logging.Formatter):
+    """Text or JSON lines; appends how many similar records the rate limiter dropped."""
+
+    def __init__(self, json_output=False):
+        super().__init__(fmt=LOG_FORMAT, datefmt='%H:%M:%S')
+        self.json_output = json_output
+
+    def format(self, record):
+        suppressed = getattr(record, 'suppressed', 0)
+        if not self.json_output:
+            line = super().format(record)
+            return f"{line} ({suppressed} similar suppressed)" if suppressed else line
+        entry = {'time': record.created, 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets ``burst`` records per message template through every ``interval`` seconds.
+
+    Records are keyed on the unformatted message, so lazily formatted calls like
+    ``logger.info("Create data point for Battery ID %s", id)`` share one budget.
+    Errors are never limited.
+    """
+
+    def __init__(self, interval=10, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        now = record.created
+        key = (record.name, record.msg)
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            suppressed = window[2] if window else 0
+            self._windows[key] = [now, 1, 0]
+            record.suppressed = suppressed
+            return True
+        if window[1] < self.burst:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands raw records to the listener thread, which does all formatting and I/O.
+
+    A full queue drops the record rather than blocking the event loop.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _console_handler(json_output=False, file=None):
+    handler = logging.FileHandler(file) if file else logging.StreamHandler()
+    handler.setFormatter(StationFormatter(json_output))
+    return handler
+
 
 def get_logger(module_name=None):
+    global _handlers
     # Use the provided module name or default to 'root'
     logger = logging.getLogger(module_name)
+    logger.setLevel(_level)
 
-    # Define the format for the logging messages
-    log_format = '%(asctime)s %(levelname)s [%(name)s] %(message)s'
-    
-    # Set the logging level
-    level = logging.INFO
-    logger.setLevel(level)
-
+    if _handlers is None:
+        _handlers = [_console_handler()]
     if not logger.handlers:
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(logging.Formatter(fmt=log_format, datefmt='%H:%M:%S'))
-        logger.addHandler(console_handler)
+        for handler in _handlers:
+            logger.addHandler(handler)
         logger.propagate = False
+    _loggers.add(logger)
 
     return logger
 
 
+def configure_logging(mode='console', format='text', level='INFO', file=None, rate_limit=None, queue_size=10000):
+    """Rewire every station logger. ``mode='queue'`` moves formatting and writes to a background thread."""
+    global _handlers, _level, _listener
+    shutdown_logging()
+    _level = logging.getLevelName(level) if isinstance(level, str) else level
+    output = _console_handler(format == 'json', file)
+    if mode == 'queue':
+        # Skip the per-record thread and process lookups nobody reads
+        logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False
+        handler = DeferredQueueHandler(queue.Queue(maxsize=queue_size))
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+    else:
+        handler = output
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(**rate_limit))
+    _handlers = [handler]
+    for logger in _loggers:
+        for old in list(logger.handlers):
+            logger.removeHandler(old)
+        logger.addHandler(handler)
+        logger.setLevel(_level)
+
+
+def shutdown_logging():
+    # Flushes whatever the listener thread still has queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
 
 def exit_process(is_error=True, delayed=False):
     from threading import Thread
@@ -33,3 +151,32 @@ def exit_process(is_error=True, delayed=False):
     if not delayed:
         import sys
         sys.exit(status)
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after a time-to-live."""
+
+    def __init__(self, maxsize=256, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)